@@ -0,0 +1,485 @@
+############################################################
+# Benchmarks for the wearable face recognition system
+# usage: python benchmark.py <benchmark> [iterations]
+############################################################
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import cv2
+import numpy
+
+from main import GCo, Camera, DataBase, DnnDetector, Trainer, FaceRecognizer, FaceTracker, LBPHEngine, personName
+from main import MotionDetector, HaarCascadeDetector, LBPDetector, CascadePlanner, ImageManagement, toFaces
+from main import modelFile, readModelVersion, readSnapshot, writeSnapshot
+
+
+def loadImages(directory, limit=64):
+    images = []
+    for f in sorted(os.listdir(directory)):
+        if f.endswith(".jpg") and len(images) < limit:
+            images.append(cv2.imread(directory + f))
+    return images
+
+
+def iou(a, b):
+    (ax, ay, aw, ah) = (a["x"], a["y"], a["w"], a["h"])
+    (bx, by, bw, bh) = (b["x"], b["y"], b["w"], b["h"])
+    w = min(ax + aw, bx + bw) - max(ax, bx)
+    h = min(ay + ah, by + bh) - max(ay, by)
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = float(w * h)
+    return inter / (aw * ah + bw * bh - inter)
+
+
+def countMatches(found, reference, threshold=0.5):
+    return len([r for r in reference if any([iou(r, f) >= threshold for f in found])])
+
+
+def printStats(title, samples):
+    samples = sorted(samples)
+    if len(samples) == 0:
+        print(title + ": no samples")
+        return
+    mean = sum(samples) / float(len(samples))
+    median = samples[len(samples) // 2]
+    print("%s: n=%d mean=%.1fms median=%.1fms min=%.1fms max=%.1fms" % (title, len(samples),
+          mean * 1000, median * 1000, samples[0] * 1000, samples[-1] * 1000))
+
+
+def loadDataset(trainer):
+    # dataset faces as (name, person id, face), every third face is held out as probe
+    dataset = GCo.WORKING_DIRECTORY + GCo.DATASET_DIR
+    db = DataBase()
+    samples = []
+    for f in sorted(os.listdir(dataset)):
+        if f.endswith(".jpg"):
+            name = f.split(".")[0]
+            id = db.getUserId(personName(name))
+            if id == None:
+                print("skipping " + f + ", not in the database (python main.py --rebuild)")
+                continue
+            samples.append((name, id, trainer._loadFace(dataset + f)))
+    probes = samples[0::3]
+    gallery = [sample for (i, sample) in enumerate(samples) if i % 3 != 0]
+    return (gallery, probes)
+
+
+
+###########################################
+# Trigger to first frame latency: pause/resume of the open
+# device against the old close/reopen + warm up cycle
+###########################################
+def benchmarkCamera(iterations):
+    camera = Camera()
+    camera.start()
+
+    resumed = []
+    for i in range(iterations):
+        camera.setEnabled(False)
+        time.sleep(1.0)
+        start = time.time()
+        camera.setEnabled(True)
+        ret, frame, timestamp = camera.readNewerThan(start)
+        if ret:
+            resumed.append(time.time() - start)
+
+    reopened = []
+    for i in range(min(iterations, 3)):
+        camera.close()
+        time.sleep(1.0)
+        start = time.time()
+        camera.start()
+        ret, frame, timestamp = camera.readNewerThan(start)
+        if ret:
+            reopened.append(time.time() - start)
+
+    camera.close()
+    print("idle fps=%d, resume discard=%d" % (GCo.CAMERA_IDLE_FPS, GCo.CAMERA_RESUME_DISCARD))
+    printStats("resume -> first frame", resumed)
+    printStats("reopen -> first frame", reopened)
+
+
+###########################################
+# DNN detection: single frame vs tiled vs batched frames.
+# Images are taken from imagesBeforeProcessed/, the reference for
+# recall is the union of the faces found by single and tiled modes
+###########################################
+def benchmarkDnn(iterations):
+    images = loadImages(GCo.WORKING_DIRECTORY + GCo.IMAGES_BEF_PROCESS)
+    if len(images) == 0:
+        print("No images found in " + GCo.IMAGES_BEF_PROCESS)
+        return
+
+    detector = DnnDetector()
+    results = {}
+    for mode in ["single", "tiled"]:
+        GCo.DNN_TILED_MODE = (mode == "tiled")
+        start = time.time()
+        for i in range(iterations):
+            faces = [detector.faceDetection(image, None) for image in images]
+        elapsed = (time.time() - start) / iterations
+        results[mode] = (faces, elapsed)
+    GCo.DNN_TILED_MODE = False
+
+    start = time.time()
+    for i in range(iterations):
+        batched = []
+        for first in range(0, len(images), GCo.FRAME_BUFFER_SIZE):
+            batched += detector.faceDetectionBatch(images[first:first+GCo.FRAME_BUFFER_SIZE])
+    results["batch"] = (batched, (time.time() - start) / iterations)
+
+    references = []
+    for index in range(len(images)):
+        reference = list(results["tiled"][0][index])
+        for face in results["single"][0][index]:
+            if not any([iou(face, r) >= 0.5 for r in reference]):
+                reference.append(face)
+        references.append(reference)
+    total = sum([len(reference) for reference in references])
+
+    print("images=%d reference faces=%d" % (len(images), total))
+    for mode in ["single", "batch", "tiled"]:
+        (faces, elapsed) = results[mode]
+        found = sum([len(f) for f in faces])
+        matched = sum([countMatches(faces[i], references[i]) for i in range(len(images))])
+        print("%-6s: %.1f frames/sec, %.1f faces/sec, recall=%.2f" % (mode, len(images) / elapsed,
+              found / elapsed, matched / float(max(total, 1))))
+
+
+###########################################
+# Full resolution LBP against coarse to fine LBP, every third
+# dataset face is held out as probe, the rest trains both models
+###########################################
+def benchmarkMultiRes(iterations):
+    trainer = Trainer()
+    (gallery, probes) = loadDataset(trainer)
+    if len(probes) == 0 or len(gallery) == 0:
+        print("not enough faces in " + GCo.DATASET_DIR)
+        return
+
+    faces = [face for (name, id, face) in gallery]
+    ids = numpy.array([id for (name, id, face) in gallery])
+    recognizer = FaceRecognizer()
+    recognizer._LBPRecognizer = cv2.face.LBPHFaceRecognizer_create()
+    recognizer._LBPRecognizer.train(faces, ids)
+    recognizer._LBPCoarseRecognizer = cv2.face.LBPHFaceRecognizer_create()
+    recognizer._LBPCoarseRecognizer.train(trainer._coarseFaces(faces), ids)
+
+    modes = [("fine", recognizer._LBPRecognizer.predict), ("multires", recognizer._predictMultiRes)]
+    print("gallery=%d probes=%d" % (len(gallery), len(probes)))
+    for (mode, predict) in modes:
+        elapsed = []
+        correct = 0
+        for i in range(iterations):
+            for (name, id, face) in probes:
+                start = time.time()
+                (label, distance) = predict(face)
+                elapsed.append(time.time() - start)
+                predicted = recognizer.db.getNamesForIds([label])[0]
+                if i == 0 and personName(predicted) == personName(name):
+                    correct += 1
+        printStats(mode, elapsed)
+        print("%s: accuracy=%.3f" % (mode, correct / float(len(probes))))
+    print("multires decisions: " + str(recognizer.getMultiResStats()))
+    recognizer.close()
+
+
+###########################################
+# NumPy LBPH engine against cv2.face LBPH: both must return the
+# same label and distance for every probe, then predict latency
+###########################################
+def benchmarkLbph(iterations):
+    trainer = Trainer()
+    (gallery, probes) = loadDataset(trainer)
+    if len(probes) == 0 or len(gallery) == 0:
+        print("not enough faces in " + GCo.DATASET_DIR)
+        return
+
+    faces = [face for (name, id, face) in gallery]
+    ids = numpy.array([id for (name, id, face) in gallery])
+    opencv = cv2.face.LBPHFaceRecognizer_create()
+    opencv.train(faces, ids)
+    engine = LBPHEngine()
+    engine.train(faces, ids)
+
+    mismatches = 0
+    worst = 0.0
+    for (name, id, face) in probes:
+        (label, distance) = opencv.predict(face)
+        (engine_label, engine_distance) = engine.predict(face)
+        worst = max(worst, abs(distance - engine_distance) / max(distance, 1e-9))
+        if label != engine_label:
+            mismatches += 1
+    print("gallery=%d probes=%d label mismatches=%d max relative distance error=%.2e" % (len(gallery),
+          len(probes), mismatches, worst))
+
+    for (mode, predict) in [("opencv", opencv.predict), ("numpy", engine.predict),
+                            ("numpy top5", lambda face: engine.predictTopK(face, 5))]:
+        elapsed = []
+        for i in range(iterations):
+            for (name, id, face) in probes:
+                start = time.time()
+                predict(face)
+                elapsed.append(time.time() - start)
+        printStats(mode, elapsed)
+
+
+###########################################
+# Exact numpy LBPH scan against the indexed gallery while the
+# gallery grows (shifted copies of the dataset faces)
+###########################################
+def benchmarkIndex(iterations):
+    trainer = Trainer()
+    (gallery, probes) = loadDataset(trainer)
+    if len(probes) == 0 or len(gallery) == 0:
+        print("not enough faces in " + GCo.DATASET_DIR)
+        return
+
+    shifts = [(dx, dy) for dx in range(-3, 4) for dy in range(-3, 4)]
+    enabled = GCo.GALLERY_INDEX_ENABLED
+    for copies in [1, 4, 16, 49]:
+        faces = []
+        ids = []
+        for (dx, dy) in shifts[:copies]:
+            faces += [numpy.roll(numpy.roll(face, dx, axis=1), dy, axis=0) for (name, id, face) in gallery]
+            ids += [id for (name, id, face) in gallery]
+
+        GCo.GALLERY_INDEX_ENABLED = False
+        exact = LBPHEngine()
+        exact.train(faces, ids)
+        GCo.GALLERY_INDEX_ENABLED = True
+        indexed = LBPHEngine()
+        indexed.train(faces, ids)
+
+        agree = 0
+        for (name, id, face) in probes:
+            if exact.predict(face)[0] == indexed.predict(face)[0]:
+                agree += 1
+        print("gallery=%d indexed=%s top1 agreement=%.3f" % (len(faces), indexed._index != None,
+              agree / float(len(probes))))
+        for (mode, engine) in [("exact", exact), ("indexed", indexed)]:
+            elapsed = []
+            for i in range(iterations):
+                for (name, id, face) in probes:
+                    start = time.time()
+                    engine.predict(face)
+                    elapsed.append(time.time() - start)
+            printStats("  " + mode, elapsed)
+    GCo.GALLERY_INDEX_ENABLED = enabled
+
+
+###########################################
+# Boot time model loading: yml read() against the binary snapshot,
+# plus the first prediction (page faults of the memory mapped arrays).
+# For a real cold boot drop the page cache before every run:
+#   sync; echo 3 | sudo tee /proc/sys/vm/drop_caches
+###########################################
+def benchmarkColdBoot(iterations):
+    version = readModelVersion(GCo.WORKING_DIRECTORY)
+    models = [(GCo.LBP_TRAINING_FILE, cv2.face.LBPHFaceRecognizer_create),
+              (GCo.EIGEN_TRAINING_FILE, cv2.face.EigenFaceRecognizer_create),
+              (GCo.FISHER_TRAINING_FILE, cv2.face.FisherFaceRecognizer_create)]
+    probe = numpy.zeros((GCo.GRIDY_SIZE, GCo.GRIDX_SIZE), dtype=numpy.uint8)
+    (gallery, probes) = loadDataset(Trainer())
+    faces = [face for (name, id, face) in gallery + probes]
+    for (model_file, create) in models:
+        model_file = GCo.WORKING_DIRECTORY + modelFile(model_file, version)
+        if not os.path.isfile(model_file) or os.path.getsize(model_file) == 0:
+            print(model_file + ": no model")
+            continue
+
+        loads = []
+        predicts = []
+        for i in range(iterations):
+            start = time.time()
+            recognizer = create()
+            recognizer.read(model_file)
+            loads.append(time.time() - start)
+            start = time.time()
+            recognizer.predict(probe)
+            predicts.append(time.time() - start)
+        if readSnapshot(model_file) == None:
+            writeSnapshot(recognizer, model_file)
+        printStats(model_file + " yml read", loads)
+        printStats(model_file + " yml first predict", predicts)
+
+        loads = []
+        predicts = []
+        for i in range(iterations):
+            start = time.time()
+            recognizer = readSnapshot(model_file)
+            loads.append(time.time() - start)
+            start = time.time()
+            recognizer.predict(probe)
+            predicts.append(time.time() - start)
+        printStats(model_file + " snapshot load", loads)
+        printStats(model_file + " snapshot first predict", predicts)
+
+        # the snapshot engine has to predict what the yml model predicts
+        yml = create()
+        yml.read(model_file)
+        mismatches = 0
+        worst = 0.0
+        for face in faces:
+            (label, distance) = yml.predict(face)
+            (snapshot_label, snapshot_distance) = recognizer.predict(face)
+            worst = max(worst, abs(distance - snapshot_distance) / max(distance, 1e-9))
+            if label != snapshot_label:
+                mismatches += 1
+        print("%s snapshot vs yml: faces=%d label mismatches=%d max relative distance error=%.2e" % (model_file,
+              len(faces), mismatches, worst))
+
+
+###########################################
+# Detection + recognition of every face on every frame against
+# the tracker. imagesBeforeProcessed/ is replayed as a video, the
+# names of the full pipeline are the reference for agreement
+###########################################
+def benchmarkTracking(iterations):
+    images = loadImages(GCo.WORKING_DIRECTORY + GCo.IMAGES_BEF_PROCESS)
+    if len(images) == 0:
+        print("No images found in " + GCo.IMAGES_BEF_PROCESS)
+        return
+
+    detector = DnnDetector()
+    recognizer = FaceRecognizer()
+    grays = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in images]
+
+    start = time.time()
+    for i in range(iterations):
+        references = []
+        for image, gray in zip(images, grays):
+            faces = toFaces(detector.faceDetection(image, gray))
+            results = recognizer.predictBatch(gray, faces)
+            references.append([dict(person, w=int(faces["w"][person["face"]]))
+                               for person in results.get(GCo.LBP_RECOGNITION, [])])
+    full = (time.time() - start) / iterations
+
+    start = time.time()
+    for i in range(iterations):
+        tracker = FaceTracker()
+        tracked = []
+        for image, gray in zip(images, grays):
+            if tracker.needsDetection():
+                tracker.update(image, detector.faceDetection(image, gray))
+            else:
+                tracker.follow(image)
+            pending = tracker.pendingRecognition()
+            if len(pending) > 0:
+                tracker.assignPeople(pending, recognizer.predictBatch(gray, tracker.getFaces(pending)))
+            tracked.append([dict(track["people"][GCo.LBP_RECOGNITION], x=track["box"][0], y=track["box"][1],
+                            w=track["box"][2], h=track["box"][3]) for track in tracker.getTracks()
+                            if GCo.LBP_RECOGNITION in track["people"]])
+    elapsed = (time.time() - start) / iterations
+    recognizer.close()
+
+    total = sum([len(reference) for reference in references])
+    agreed = 0
+    for reference, people in zip(references, tracked):
+        for person in reference:
+            agreed += len([p for p in people if p["name"] == person["name"] and iou(person, p) >= 0.5]) > 0
+    stats = tracker.getStats()
+    print("frames=%d reference people=%d detect interval=%d tracker=%s" % (len(images), total,
+          GCo.TRACK_DETECT_INTERVAL, GCo.TRACKER_TYPE))
+    print("full   : %.1f frames/sec" % (len(images) / full))
+    print("tracked: %.1f frames/sec, detections=%d, recognized=%d, cached=%d, agreement=%.2f" % (len(images) / elapsed,
+          stats["detections"], stats["recognized"], stats["cached"], agreed / float(max(total, 1))))
+
+
+###########################################
+# Motion gate cost per frame against the dnn detector, the
+# imagesBeforeProcessed/ pictures are replayed as idle frames
+###########################################
+def benchmarkMotion(iterations):
+    images = loadImages(GCo.WORKING_DIRECTORY + GCo.IMAGES_BEF_PROCESS)
+    if len(images) == 0:
+        print("No images found in " + GCo.IMAGES_BEF_PROCESS)
+        return
+
+    GCo.MOTION_MIN_INTERVAL = 0
+    triggers = 0
+    for i in range(iterations):
+        motion = MotionDetector()
+        triggers += len([n for n in range(len(images)) if motion.shouldTrigger(images[n], n + 1)])
+    stats = motion.getStats()
+
+    detector = DnnDetector()
+    start = time.time()
+    for image in images:
+        detector.faceDetection(image, None)
+    detection = (time.time() - start) / len(images)
+
+    print("frames=%d triggers=%.1f per replay, %s" % (len(images), triggers / float(iterations), stats))
+    print("motion: %.2f ms/frame, dnn detection: %.2f ms/frame" % (stats["time"] * 1000 / max(stats["frames"], 1),
+          detection * 1000))
+
+
+###########################################
+# Cascade detection on the full frame against the planned one
+# (distance range sizes on a reduced frame) and against the planned
+# one replayed as a sequence (regions around the previous faces).
+# Recall is measured on the full frame faces within the distance range
+###########################################
+def benchmarkCascade(iterations):
+    images = loadImages(GCo.WORKING_DIRECTORY + GCo.IMAGES_BEF_PROCESS)
+    if len(images) == 0:
+        print("No images found in " + GCo.IMAGES_BEF_PROCESS)
+        return
+
+    im = ImageManagement()
+    grays = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in images]
+    print("images=%d distance range=%d-%dcm" % (len(images), GCo.DETECTION_MIN_DISTANCE, GCo.DETECTION_MAX_DISTANCE))
+    for (title, detector_class) in [("haar", HaarCascadeDetector), ("lbp", LBPDetector)]:
+        detector = detector_class()
+        results = {}
+        for mode in ["full", "planned", "sequence"]:
+            start = time.time()
+            for i in range(iterations):
+                planner = CascadePlanner(detector._face_cascade)
+                faces = []
+                for gray in grays:
+                    if mode == "full":
+                        found = detector._face_cascade.detectMultiScale(gray, 1.3, 5)
+                    else:
+                        if mode == "planned":
+                            planner = CascadePlanner(detector._face_cascade)
+                        found = planner.detect(gray)
+                    faces.append([{"x": x, "y": y, "w": w, "h": h} for (x, y, w, h) in found])
+            results[mode] = (faces, (time.time() - start) / iterations / len(grays), planner.getStats())
+
+        references = [[face for face in faces if GCo.DETECTION_MIN_DISTANCE <= im.calcDistance(face["x"], face["y"], face["h"])
+                       <= GCo.DETECTION_MAX_DISTANCE] for faces in results["full"][0]]
+        total = sum([len(reference) for reference in references])
+        print("%s: full frame faces=%d, in range=%d" % (title, sum([len(f) for f in results["full"][0]]), total))
+        for mode in ["full", "planned", "sequence"]:
+            (faces, elapsed, stats) = results[mode]
+            matched = sum([countMatches(faces[n], references[n]) for n in range(len(grays))])
+            print("  %-8s: %.1f ms/frame, recall=%.2f %s" % (mode, elapsed * 1000, matched / float(max(total, 1)),
+                  stats if mode == "sequence" else ""))
+
+
+BENCHMARKS = {
+    "camera": benchmarkCamera,
+    "dnn": benchmarkDnn,
+    "multires": benchmarkMultiRes,
+    "lbph": benchmarkLbph,
+    "index": benchmarkIndex,
+    "coldboot": benchmarkColdBoot,
+    "tracking": benchmarkTracking,
+    "motion": benchmarkMotion,
+    "cascade": benchmarkCascade,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("usage: python benchmark.py <" + "|".join(sorted(BENCHMARKS)) + "> [iterations]")
+        sys.exit(1)
+
+    iterations = 10
+    if len(sys.argv) > 2:
+        iterations = int(sys.argv[2])
+
+    BENCHMARKS[sys.argv[1]](iterations)
@@ -6,12 +6,91 @@
 
 import numpy as np
 import time
+import math
 import cv2
 import os
+import sys
 import sqlite3
 import datetime
+import threading
+import multiprocessing
+import collections
+import contextlib
+import heapq
+import hashlib
+import json
+import subprocess
+import shutil
+import wave
+import audioop
+from multiprocessing.pool import ThreadPool
 from PIL import Image
 import RPi.GPIO as GPIO
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+def personName(name):
+    # dataset samples are named <person><detector>, i.e. U1hc, U1dnn
+    for suffix in ["dnn", "hc", "lbp"]:
+        if name != None and name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def removeFile(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+###########################################
+# Model versions: version 0 uses the plain file names,
+# version N the recognizer/<model>.vN.yml files
+###########################################
+def modelFile(model_file, version):
+    if version == 0:
+        return model_file
+    (base, extension) = os.path.splitext(model_file)
+    return base + ".v" + str(version) + extension
+
+def readModelVersion(path):
+    try:
+        with open(path + GCo.MODEL_VERSION_FILE) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return 0
+
+def writeModelVersion(path, version):
+    temp_file = path + GCo.MODEL_VERSION_FILE + ".tmp"
+    with open(temp_file, "w") as f:
+        f.write(str(version))
+    os.rename(temp_file, path + GCo.MODEL_VERSION_FILE)
+
+def removeModelVersions(path, keep=None):
+    # versioned files older than keep (all with None), newer ones may be in training
+    directory = os.path.dirname(path + GCo.LBP_TRAINING_FILE)
+    if not os.path.isdir(directory):
+        return
+    models = [os.path.splitext(os.path.basename(model_file))[0] for model_file in
+              [GCo.LBP_TRAINING_FILE, GCo.LBP_COARSE_TRAINING_FILE, GCo.EIGEN_TRAINING_FILE, GCo.FISHER_TRAINING_FILE]]
+    for f in os.listdir(directory):
+        parts = f.split(".")
+        if len(parts) >= 3 and parts[0] in models and parts[1][:1] == "v" and parts[1][1:].isdigit() \
+                and (keep == None or int(parts[1][1:]) < keep):
+            os.remove(os.path.join(directory, f))
+
+def removeModels(path):
+    # every trained model, snapshot and index, the models are left empty as by a fresh install
+    removeFile(path + GCo.LBP_COARSE_TRAINING_FILE)
+    for model_file in [GCo.LBP_TRAINING_FILE, GCo.LBP_COARSE_TRAINING_FILE,
+                       GCo.EIGEN_TRAINING_FILE, GCo.FISHER_TRAINING_FILE]:
+        removeSnapshot(path + model_file)
+    removeFile(path + GCo.MODEL_VERSION_FILE)
+    removeModelVersions(path)
+    removeFile(galleryIndexFile(path + GCo.LBP_TRAINING_FILE))
+    removeFile(galleryIndexFile(path + GCo.LBP_COARSE_TRAINING_FILE))
+
+    for model_file in [GCo.LBP_TRAINING_FILE, GCo.EIGEN_TRAINING_FILE, GCo.FISHER_TRAINING_FILE]:
+        open(path + model_file, "w").close()
 
 def singleton(cls):
     instance=cls()
@@ -93,20 +172,128 @@ class GCo:
     SKIP_FRAMES          = 1500  # 150 (3 sec camera, 1 sec face detection)
                           #  50 (1 sec camera, 1 sec face detection)
     CONFIDENCE_GRADE     = 0.3
+    DNN_NMS_THRESHOLD    = 0.4   # overlap allowed between dnn boxes (0 = no NMS)
+    DNN_INPUT_SIZE       = 300   # input size of the caffe ssd network
+    DNN_TILED_MODE       = False # full frame + overlapped tiles in one forward pass
+    DNN_TILES_X          = 2
+    DNN_TILES_Y          = 2
+    DNN_TILE_OVERLAP     = 0.25
+    DNN_MEAN             = (104.0, 177.0, 123.0)
+
+    # Cascade detectors only search the face sizes of the supported distance
+    # range (calcDistance model) on a reduced frame, the regions around the
+    # recent detections are searched first
+    CASCADE_PLANNING     = True
+    DETECTION_MIN_DISTANCE = 50      # cm
+    DETECTION_MAX_DISTANCE = 400     # cm
+    CASCADE_SIZE_MARGIN  = 0.2       # face size tolerance of the distance model
+    CASCADE_SCALE_FACTOR = 1.3
+    CASCADE_MIN_NEIGHBORS = 5
+    CASCADE_ROI_MAX_AGE  = 2.0       # seconds the previous detections are searched first
+    CASCADE_ROI_MARGIN   = 0.5       # previous box grown by this fraction on every side
+    CASCADE_FULL_SCAN_EVERY = 5      # region scans before a full scan looks for new faces
+    FACE_DTYPE           = np.dtype([("x", np.int32), ("y", np.int32), ("w", np.int32),
+                                     ("h", np.int32), ("conf", np.float32)])
+    FRAME_BUFFER_SIZE    = 4     # frames kept by the camera grabber thread
+    FRAME_WAIT_TIMEOUT   = 2.0   # max seconds to wait for a fresh frame
+    CAMERA_IDLE_FPS      = 2     # grab rate while camera is paused (0 = no grabbing)
+    CAMERA_RESUME_DISCARD = 4    # stale V4L2 buffers dropped when resuming
+
+    # Detection is triggered by scene changes instead of every SKIP_FRAMES loops,
+    # while paused the camera decodes CAMERA_IDLE_FPS frames for the motion detector
+    MOTION_TRIGGER_ENABLED = True
+    MOTION_WIDTH         = 80        # width of the gray copy compared
+    MOTION_PIXEL_THRESHOLD = 25      # gray level change of a moving pixel
+    MOTION_AREA          = 0.02      # fraction of moving pixels that triggers
+    MOTION_LEARNING_RATE = 0.05      # background update per frame
+    MOTION_MIN_INTERVAL  = 2.0       # seconds between triggers
+    MOTION_MAX_INTERVAL  = 60.0      # trigger anyway after this many seconds
+
+    # Detector, resolution and detection interval chosen from the measured
+    # stage costs, a face has to be announced within SCHEDULER_TARGET_LATENCY
+    # and the vision work can use SCHEDULER_CPU_BUDGET of the wall time
+    SCHEDULER_ENABLED    = False
+    SCHEDULER_TARGET_LATENCY = 1.5   # seconds from capture to announcement
+    SCHEDULER_CPU_BUDGET = 0.5
+    SCHEDULER_SMOOTHING  = 0.2       # weight of a new sample in the stage averages
+    SCHEDULER_MODES      = [(DNN, 1.0), (HAAR_CASCADE, 1.0), (DNN, 0.75), (HAAR_CASCADE, 0.75),
+                            (LBP, 1.0), (HAAR_CASCADE, 0.5), (LBP, 0.5)]  # (detector, resolution), preferred first
+    SCHEDULER_PRIOR_COSTS = {DNN: 0.8, HAAR_CASCADE: 0.4, LBP: 0.15}     # full resolution seconds on the pi
+    SCHEDULER_MAX_INTERVAL = 30.0    # longest time between detections
+    DISPLAY_WAIT         = 50        # ms waiting for a key in every loop
 
     WORKING_DIRECTORY    = "./"
+    BOOT_THREADS         = 4       # components loaded concurrently at boot
     DATASET_DIR          = "dataset/"
+    DATASET_STAGING_DIR  = "dataset_staging/"  # rebuilt dataset, swapped in when complete
+    DATASET_OLD_DIR      = "dataset_old/"
     TEMP_DIR             = "dataset_temp_dir/"
     FACES_DIR            = "facesDetected/"
     IMAGES_BEF_PROCESS   = "imagesBeforeProcessed/"
 
     DATABASE_FILE        = "database.db"
 
+    FACE_CACHE_DIR       = "cache/faces/"
+    FACE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
     LBP_ENABLED          = True
     EIGEN_ENABLED        = False
     FISHER_ENABLED       = False
 
+    # Recognizers run in order (cheapest first), a face accepted by a stage
+    # (distance <= threshold) is not evaluated by the following stages
+    RECOGNITION_CASCADE  = False
+    CASCADE_ORDER        = [LBP_RECOGNITION, EIGEN_RECOGNITION, FISHER_RECOGNITION]
+    CASCADE_THRESHOLDS   = {LBP_RECOGNITION: 45.0, EIGEN_RECOGNITION: 3000.0, FISHER_RECOGNITION: 400.0}
+
+    # Coarse LBP model screens the faces, the full GRIDX_SIZE x GRIDY_SIZE model
+    # is only consulted when the best person does not win by COARSE_MARGIN
+    MULTIRES_ENABLED     = False
+    COARSE_GRID_SIZE     = 64
+    COARSE_MARGIN        = 8.0
+    COARSE_CANDIDATES    = 20
+
+    # "opencv" (cv2.face) or "numpy" (LBPHEngine, top-k matching)
+    LBPH_BACKEND         = "opencv"
+    LBPH_UNIFORM         = False     # 59 bin uniform patterns, not readable by opencv
+    LBPH_DTYPE           = "float32" # "float16" halves the gallery memory
+    LBPH_CHUNK_ROWS      = 256       # gallery rows scored per broadcast
+
+    # "opencv" (cv2.face) or "numpy" (SubspaceEngine) for Eigen and Fisher
+    SUBSPACE_BACKEND     = "opencv"
+
+    # Full retrain in a separate process after every enrollment, the new
+    # model version is loaded in background and swapped in when ready
+    BACKGROUND_TRAINING  = EIGEN_ENABLED or FISHER_ENABLED
+    TRAINING_ANNOUNCE_INTERVAL = 30.0   # seconds between "loading" announcements
+
+    # Continuous mode: every face keeps a track between frames, the detector
+    # only runs every TRACK_DETECT_INTERVAL frames or when a track is lost and
+    # only new or uncertain tracks go through the recognizers again
+    TRACKING_ENABLED     = False
+    TRACKER_TYPE         = "MOSSE"   # "MOSSE", "KCF", "MIL" or "" (follow detections only)
+    TRACK_DETECT_INTERVAL = 15       # frames between full detections
+    TRACK_IOU_THRESHOLD  = 0.3
+    TRACK_CENTROID_DISTANCE = 0.5    # fallback association, fraction of the face height
+    TRACK_MAX_MISSES     = 2         # detections a track can miss before it is dropped
+    TRACK_RECOGNIZE_INTERVAL = 5.0   # seconds before a confident track is recognized again
+
+    # Indexed gallery for the numpy backend (PCA + IVF lists, exact re-ranking),
+    # only used once the gallery has INDEX_MIN_SIZE samples
+    GALLERY_INDEX_ENABLED = False
+    INDEX_MIN_SIZE       = 1000
+    INDEX_PCA_SIZE       = 64
+    INDEX_PCA_SAMPLES    = 1024      # gallery rows used to fit the projection
+    INDEX_LISTS          = 0         # 0 = sqrt(gallery size)
+    INDEX_PROBES         = 4         # lists visited per probe
+    INDEX_SHORTLIST      = 64        # rows re-ranked with the exact distance
+    INDEX_KMEANS_ITERATIONS = 20
+    INDEX_REBUILD_FACTOR = 2.0       # re-cluster when the gallery doubles
+
+    MODEL_VERSION_FILE   = "recognizer/version.txt"  # models in use, written once they are swapped in
+    MODEL_SNAPSHOTS      = True      # memory mapped binary copies of the yml models of the numpy backends, loaded at boot
     LBP_TRAINING_FILE    = "recognizer/LBPData.yml"
+    LBP_COARSE_TRAINING_FILE = "recognizer/LBPDataCoarse.yml"
     EIGEN_TRAINING_FILE  = "recognizer/EigenData.yml"
     FISHER_TRAINING_FILE = "recognizer/FisherData.yml"
     PROTOTXT_FILE        = "deploy.prototxt"
@@ -122,6 +309,22 @@ class GCo:
     AUDIODISTANCES       = "distances/"
     AUDIOPLAYER          = "aplay"
     AUDIORECORDER        = "python recorder.py "
+    AUDIO_SINK           = "aplay"   # aplay, file or null
+    AUDIO_SINK_FILE      = "audio_output.wav"
+    AUDIO_RATE           = 48000     # same format recorder.py generates
+    AUDIO_CHANNELS       = 1
+    AUDIO_SAMPWIDTH      = 2
+    AUDIO_CHUNK_TIME     = 0.05      # seconds written to the sink at once
+    AUDIO_LEAD_TIME      = 0.2       # max seconds written ahead of the speaker
+    AU_PRIORITY_MENU     = 0         # menu chatter, preempted by announcements
+    AU_PRIORITY_ANNOUNCE = 1         # detection, identity and distance announcements
+    AU_MENU_MAX_AGE      = 3.0       # seconds a queued prompt is still worth playing
+    AU_ANNOUNCE_MAX_AGE  = 6.0
+    AU_PHRASE_CACHE_SIZE = 64        # compiled name+distance / people phrases kept
+    AU_DISTANCE_TABLE_SIZE = 1000    # cm covered by the distance clip lookup table
+    AU_IDENTITY_TTL      = 30.0      # seconds before the same person is announced again
+    AU_IDENTITY_MOVE     = 0.3       # relative distance change that announces a person again
+    AU_IDENTITY_CACHE_SIZE = 64      # people remembered by the announcement memory
 
     AU_DETECTION         = "detection"
     AU_RECOGNITION       = "recognition"
@@ -200,6 +403,12 @@ class Camera:
         self._camera = None
         self._number = 0
         self._enabled = False
+        self._frames = collections.deque(maxlen=GCo.FRAME_BUFFER_SIZE)
+        self._frameLock = threading.Condition()
+        self._grabber = None
+        self._grabbing = False
+        self._streaming = threading.Event()
+        self._discard = 0
         self._initializeHardware()
 
     def _initializeHardware(self):
@@ -222,25 +431,135 @@ class Camera:
         print("Warming up camera")
         time.sleep(2.0)
         print("Warming up done")
+
+    def _startGrabber(self):
+        self._grabbing = True
+        self._grabber = threading.Thread(target=self._grabFrames, name="CameraGrabber")
+        self._grabber.daemon = True
+        self._grabber.start()
+
+    def _stopGrabber(self):
+        self._grabbing = False
+        self._streaming.set()
+        if self._grabber != None:
+            self._grabber.join()
+            self._grabber = None
+        with self._frameLock:
+            self._frames.clear()
+            self._frameLock.notify_all()
+
+    def _grabFrames(self):
+        ###########################################
+        # Keep draining the device so the ring buffer always
+        # holds the newest frames, stale V4L2 buffers never
+        # reach the controller
+        ###########################################
+        while self._grabbing:
+            if not self._streaming.is_set():
+                ###########################################
+                # Paused: device stays open, optionally grab (no decode)
+                # at a low rate to keep exposure and buffers fresh
+                ###########################################
+                if GCo.CAMERA_IDLE_FPS > 0:
+                    if GCo.MOTION_TRIGGER_ENABLED:
+                        # decoded, the motion detector watches the idle frames
+                        ret, frame = self._camera.read()
+                        if ret:
+                            with self._frameLock:
+                                self._frames.append((time.time(), frame))
+                                self._frameLock.notify_all()
+                    else:
+                        self._camera.grab()
+                    self._streaming.wait(1.0 / GCo.CAMERA_IDLE_FPS)
+                else:
+                    self._streaming.wait(0.5)
+                continue
+
+            if self._discard > 0:
+                self._discard -= 1
+                self._camera.grab()
+                continue
+
+            ret, frame = self._camera.read()
+            timestamp = time.time()
+            if not ret:
+                time.sleep(0.01)
+                continue
+
+            with self._frameLock:
+                self._frames.append((timestamp, frame))
+                self._frameLock.notify_all()
     
     def isEnabled(self):
         return self._enabled
 
     def setEnabled(self, enabled):
         self._enabled = enabled
-        self.close()
         if enabled:
-           self.start(self._number)
-           
+            if self._camera == None:
+                self.start(self._number)
+            else:
+                self.resume()
+        else:
+            self.pause()
+
+    def isStreaming(self):
+        return self._streaming.is_set()
+
+    def pause(self):
+        # keeps the device open, only the frame decoding stops
+        if self._camera == None or not self._streaming.is_set():
+            return
+        self._streaming.clear()
+        with self._frameLock:
+            self._frames.clear()
+
+    def resume(self):
+        if self._streaming.is_set():
+            return
+        self._discard = GCo.CAMERA_RESUME_DISCARD
+        self._streaming.set()
 
     def read(self):
-        return self._camera.read()
+        ret, frame, timestamp = self.readLatest()
+        return ret, frame
+
+    def readLatest(self):
+        # returns the newest buffered frame without waiting
+        with self._frameLock:
+            if len(self._frames) == 0:
+                return False, None, 0
+            timestamp, frame = self._frames[-1]
+        return True, frame.copy(), timestamp
+
+    def readBuffered(self):
+        # every frame in the ring buffer, oldest first
+        with self._frameLock:
+            return [frame.copy() for (timestamp, frame) in self._frames]
+
+    def readNewerThan(self, since, timeout=GCo.FRAME_WAIT_TIMEOUT):
+        # waits until a frame captured after "since" is available
+        deadline = time.time() + timeout
+        with self._frameLock:
+            while len(self._frames) == 0 or self._frames[-1][0] <= since:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._grabbing:
+                    return False, None, 0
+                self._frameLock.wait(remaining)
+            timestamp, frame = self._frames[-1]
+        return True, frame.copy(), timestamp
     
     def start(self, number=0):
+        if self._camera != None:
+            self.resume()
+            return self._camera
+
         self._number = number
         self._camera = cv2.VideoCapture(self._number)
         self._adjustSettings()
         self._warmUp()
+        self._streaming.set()
+        self._startGrabber()
         return self._camera
 
     def stop(self):
@@ -248,7 +567,273 @@ class Camera:
 
     def close(self):
 #       cv2.destroyAllWindows()
-        self._camera.release()
+        self._stopGrabber()
+        self._streaming.clear()
+        if self._camera != None:
+            self._camera.release()
+            self._camera = None
+
+class NullSink():
+    # discards audio, used when there is no audio device
+    def __init__(self):
+        self.realtime = False
+
+    def open(self, rate, channels, sampwidth):
+        pass
+
+    def write(self, pcm):
+        pass
+
+    def close(self):
+        pass
+
+class FileSink(NullSink):
+    # writes everything played into a wav file, allows headless testing
+    def __init__(self, filename):
+        NullSink.__init__(self)
+        self._filename = filename
+        self._wav = None
+
+    def open(self, rate, channels, sampwidth):
+        self._wav = wave.open(self._filename, "wb")
+        self._wav.setnchannels(channels)
+        self._wav.setsampwidth(sampwidth)
+        self._wav.setframerate(rate)
+
+    def write(self, pcm):
+        self._wav.writeframes(pcm)
+
+    def close(self):
+        if self._wav != None:
+            self._wav.close()
+            self._wav = None
+
+class AplaySink(NullSink):
+    # one long lived aplay process fed with raw pcm through its stdin
+    def __init__(self):
+        NullSink.__init__(self)
+        self.realtime = True
+        self._process = None
+        self._format = None
+
+    def open(self, rate, channels, sampwidth):
+        self._format = (rate, channels, sampwidth)
+        formats = {1: "U8", 2: "S16_LE", 4: "S32_LE"}
+        self._process = subprocess.Popen([GCo.AUDIOPLAYER, "-q", "-t", "raw", "-f", formats[sampwidth],
+                                          "-r", str(rate), "-c", str(channels)], stdin=subprocess.PIPE)
+
+    def write(self, pcm):
+        try:
+            self._process.stdin.write(pcm)
+            self._process.stdin.flush()
+        except (IOError, OSError):
+            print("Warning: audio player closed, restarting it")
+            self.close()
+            self.open(*self._format)
+
+    def close(self):
+        if self._process != None:
+            try:
+                self._process.stdin.close()
+            except (IOError, OSError):
+                pass
+            self._process.wait()
+            self._process = None
+
+def createAudioSink():
+    if GCo.AUDIO_SINK == "file":
+        return FileSink(GCo.WORKING_DIRECTORY + GCo.AUDIO_SINK_FILE)
+    elif GCo.AUDIO_SINK == "null":
+        return NullSink()
+    return AplaySink()
+
+class AudioClip():
+    def __init__(self, name, pcm, duration):
+        self.name = name
+        self.pcm = pcm
+        self.duration = duration
+
+class AudioRequest():
+    def __init__(self, clips, priority, key, expires):
+        self.clips = clips
+        self.priority = priority
+        self.key = key
+        self.expires = expires
+        self.cancelled = False
+        self.preempted = False
+        self.created = time.time()
+        self.done = threading.Event()
+        self.endsAt = 0
+
+class AudioEngine():
+    ###########################################################################
+    # Clips are decoded once into memory in the sink format and played by a
+    # single thread through one long lived output stream.
+    # Requests are scheduled by priority: announcements interrupt menu chatter,
+    # requests older than their max age are dropped (requests without a max
+    # age are always played) and a new request with the same key replaces the
+    # one still queued.
+    ###########################################################################
+    def __init__(self, sink):
+        self._sink = sink
+        self._rate = GCo.AUDIO_RATE
+        self._channels = GCo.AUDIO_CHANNELS
+        self._sampwidth = GCo.AUDIO_SAMPWIDTH
+        self._frame_bytes = self._channels * self._sampwidth
+        self._bytes_per_second = float(self._rate * self._frame_bytes)
+        self._chunk = int(self._rate * GCo.AUDIO_CHUNK_TIME) * self._frame_bytes
+        self._playedUntil = 0
+        self._pending = []
+        self._sequence = 0
+        self._current = None
+        self._closing = False
+        self._cond = threading.Condition()
+        self._stats = {"played": 0, "preempted": 0, "dropped": 0, "coalesced": 0, "announced": 0, "waited": 0.0}
+        self._sink.open(self._rate, self._channels, self._sampwidth)
+        self._player = threading.Thread(target=self._playRequests, name="AudioPlayer")
+        self._player.daemon = True
+        self._player.start()
+
+    def _convert(self, pcm, rate, channels, sampwidth):
+        ###########################################
+        # Bring any wav file to the sink format
+        ###########################################
+        if sampwidth == 1:
+            pcm = audioop.bias(pcm, 1, -128)
+        if sampwidth != self._sampwidth:
+            pcm = audioop.lin2lin(pcm, sampwidth, self._sampwidth)
+        if channels == 2 and self._channels == 1:
+            pcm = audioop.tomono(pcm, self._sampwidth, 0.5, 0.5)
+        elif channels == 1 and self._channels == 2:
+            pcm = audioop.tostereo(pcm, self._sampwidth, 1, 1)
+        if rate != self._rate:
+            pcm, state = audioop.ratecv(pcm, self._sampwidth, self._channels, rate, self._rate, None)
+        return pcm
+
+    def loadClip(self, filename):
+        if not os.path.isfile(filename):
+            return None
+        try:
+            wav = wave.open(filename, "rb")
+            pcm = wav.readframes(wav.getnframes())
+            pcm = self._convert(pcm, wav.getframerate(), wav.getnchannels(), wav.getsampwidth())
+            wav.close()
+        except (wave.Error, EOFError, audioop.error):
+            print("Warning: unable to decode audio file " + filename)
+            return None
+        name = os.path.split(filename)[-1][:-len(".wav")]
+        return AudioClip(name, pcm, len(pcm) / self._bytes_per_second)
+
+    def loadBank(self, directory):
+        bank = {}
+        if not os.path.isdir(directory):
+            return bank
+        for f in os.listdir(directory):
+            if f.endswith(".wav"):
+                clip = self.loadClip(directory + f)
+                if clip != None:
+                    bank[clip.name] = clip
+        return bank
+
+    def _release(self, request):
+        request.endsAt = self._playedUntil
+        request.done.set()
+
+    def _nextRequest(self):
+        with self._cond:
+            while True:
+                while len(self._pending) == 0 and not self._closing:
+                    self._cond.wait()
+                if len(self._pending) == 0:
+                    return None
+
+                priority, sequence, request = heapq.heappop(self._pending)
+                if request.cancelled:
+                    continue
+                if request.expires != None and time.time() > request.expires:
+                    self._stats["dropped"] += 1
+                    self._release(request)
+                    continue
+
+                if request.priority >= GCo.AU_PRIORITY_ANNOUNCE and request.expires != None:
+                    # queue wait of the detection announcements, not of the boot prompts
+                    self._stats["announced"] += 1
+                    self._stats["waited"] += time.time() - request.created
+                self._current = request
+                return request
+
+    def _playRequests(self):
+        while True:
+            request = self._nextRequest()
+            if request == None:
+                break
+
+            for clip in request.clips:
+                pcm = clip.pcm
+                for offset in range(0, len(pcm), self._chunk):
+                    if request.preempted:
+                        break
+                    data = pcm[offset:offset+self._chunk]
+                    if self._sink.realtime:
+                        # do not get too far ahead of the speaker
+                        ahead = self._playedUntil - time.time()
+                        if ahead > GCo.AUDIO_LEAD_TIME:
+                            time.sleep(ahead - GCo.AUDIO_LEAD_TIME)
+                        self._playedUntil = max(self._playedUntil, time.time()) + len(data) / self._bytes_per_second
+                    self._sink.write(data)
+
+            with self._cond:
+                self._current = None
+                if request.preempted:
+                    self._stats["preempted"] += 1
+                else:
+                    self._stats["played"] += 1
+            self._release(request)
+
+    def play(self, clips, wait=False, priority=GCo.AU_PRIORITY_MENU, key=None, maxAge=GCo.AU_MENU_MAX_AGE):
+        expires = None
+        if maxAge != None:
+            expires = time.time() + maxAge
+        request = AudioRequest(clips, priority, key, expires)
+        with self._cond:
+            ###########################################
+            # Coalesce with queued request of same key and
+            # interrupt lower priority audio being played
+            ###########################################
+            if key != None:
+                for queued in self._pending:
+                    if queued[2].key == key and not queued[2].cancelled:
+                        queued[2].cancelled = True
+                        self._stats["coalesced"] += 1
+                        self._release(queued[2])
+            if self._current != None and self._current.priority < priority:
+                self._current.preempted = True
+
+            self._sequence += 1
+            heapq.heappush(self._pending, (-priority, self._sequence, request))
+            self._cond.notify()
+
+        if wait:
+            request.done.wait()
+            remaining = request.endsAt - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+        return request
+
+    def isBusy(self):
+        with self._cond:
+            return self._current != None or len(self._pending) > 0
+
+    def getStats(self):
+        with self._cond:
+            return dict(self._stats)
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._player.join()
+        self._sink.close()
 
 @singleton
 class AudioController:
@@ -256,12 +841,85 @@ class AudioController:
         self._path = GCo.WORKING_DIRECTORY
         self._languages = ["espanol", "english"]
         self._current_language = 0
+        self._engine = AudioEngine(createAudioSink())
+        self._phrases = collections.OrderedDict()
+        self._distances = [self._distanceClipName(d) for d in range(GCo.AU_DISTANCE_TABLE_SIZE)]
+        self._announced = collections.OrderedDict()
+        self._identityStats = {"new": 0, "expired": 0, "moved": 0, "suppressed": 0}
+        self._loadBanks()
+
+    def _distanceClipName(self, distance):
+        strdist=str(int(round(distance%100/10.0))*10)
+        if distance >= 400:
+            strdist = str(distance//100) + "m"
+        elif distance < 95:
+            strdist += "cm"
+        else:
+            strdist = str(distance//100) + "m" + strdist + "cm"
+        return strdist
+
+    def _compilePhrase(self, key, clips, label):
+        ###########################################
+        # Concatenate the pcm of the clips into a single gapless
+        # clip, the most recently used phrases are kept
+        ###########################################
+        phrase = self._phrases.pop(key, None)
+        if phrase == None:
+            if None in clips:
+                print("Warning: audio clip " + label + " not found")
+                clips = [clip for clip in clips if clip != None]
+                if len(clips) == 0:
+                    return None
+            phrase = AudioClip(label, b"".join([clip.pcm for clip in clips]), sum([clip.duration for clip in clips]))
+            if len(self._phrases) >= GCo.AU_PHRASE_CACHE_SIZE:
+                self._phrases.popitem(last=False)
+        self._phrases[key] = phrase
+        return phrase
+
+    def _loadBanks(self):
+        ###########################################
+        # Decode every clip of every language once, changing
+        # language only switches the bank in use
+        ###########################################
+        start = time.time()
+        self._names = self._engine.loadBank(self._path + GCo.AUDIONAMES)
+        self._banks = []
+        for language in self._languages:
+            self._banks.append({
+                GCo.AUDIOCOMMANDS: self._engine.loadBank(self._path + GCo.AUDIOCOMMANDS + language + "/"),
+                GCo.AUDIOPEOPLE: self._engine.loadBank(self._path + GCo.AUDIOPEOPLE + language + "/"),
+                GCo.AUDIODISTANCES: self._engine.loadBank(self._path + GCo.AUDIODISTANCES + language + "/")})
+        end = time.time()
+        print("Audio clips loading time=", end-start)
+
+    def _play(self, clips, label, wait, priority=GCo.AU_PRIORITY_MENU, key=None, expires=True):
+        clips = [clip for clip in clips if clip != None]
+        if len(clips) == 0:
+            print("Warning: audio clip " + label + " not found")
+            return
+
+        # only fire and forget prompts expire, a waiting caller
+        # goes on as if the user heard the prompt
+        maxAge = None
+        if expires and not wait:
+            maxAge = GCo.AU_MENU_MAX_AGE
+            if priority >= GCo.AU_PRIORITY_ANNOUNCE:
+                maxAge = GCo.AU_ANNOUNCE_MAX_AGE
+        self._engine.play(clips, wait, priority, key, maxAge)
+
+    def _getClip(self, bank, name):
+        return self._banks[self._current_language][bank].get(name)
+
+    def _getName(self, name):
+        if name not in self._names:
+            self.reloadName(name)
+        return self._names.get(name)
 
     def getCurrentLanguage(self):
         return self._current_language
 
     def setCurrentLanguage(self, current_language):
-        self._current_language = self.current_language
+        self._current_language = current_language
 
     def setNextLanguage(self):
         self._current_language += 1 
@@ -273,44 +931,113 @@ class AudioController:
         if self._current_language < 0:
             self._current_language = len(self._languages) - 1
 
+    def reloadName(self, name):
+        # names are recorded at registration time
+        clip = self._engine.loadClip(self._path + GCo.AUDIONAMES + name + ".wav")
+        if clip != None:
+            self._names[name] = clip
+            for key in [key for key in self._phrases if key[1] == name]:
+                del self._phrases[key]
+
     def cmdName(self, name, wait = False):
         print("name=",name)
-        async = "&"
-        if wait:
-            async=""
-        os.system(GCo.AUDIOPLAYER + " " + self._path + GCo.AUDIONAMES + name + ".wav" + async)
+        self._play([self._getName(name)], GCo.AUDIONAMES + name, wait, GCo.AU_PRIORITY_ANNOUNCE)
 
-    def cmdSound(self, command, wait = False):
-        async = "&"
-        if wait:
-            async=""
-        os.system(GCo.AUDIOPLAYER + " " + self._path + GCo.AUDIOCOMMANDS + self._languages[self._current_language] + "/" + command + ".wav" + async)
+    def cmdSound(self, command, wait = False, priority = GCo.AU_PRIORITY_MENU, expires = True):
+        self._play([self._getClip(GCo.AUDIOCOMMANDS, command)], GCo.AUDIOCOMMANDS + command, wait, priority,
+                   expires=expires)
+
+    def cmdBoot(self, command):
+        # boot prompts never block nor expire, "ready" is the only sign the device is usable
+        self.cmdSound(command, False, GCo.AU_PRIORITY_ANNOUNCE, expires=False)
+
+    def cmdMenu(self, command):
+        # menu prompts never block the loop, a new prompt replaces the queued one
+        self._play([self._getClip(GCo.AUDIOCOMMANDS, command)], GCo.AUDIOCOMMANDS + command, False,
+                   GCo.AU_PRIORITY_MENU, key="menu")
+
+    def cmdAnnounce(self, command, wait = False):
+        self.cmdSound(command, wait, GCo.AU_PRIORITY_ANNOUNCE)
 
     def cmdPeopleDetected(self, detected_people, wait=True):
-        async = "&"
-        if wait:
-            async=""
-        os.system(GCo.AUDIOPLAYER + " " + self._path + GCo.AUDIOPEOPLE + self._languages[self._current_language] + "/" + str(detected_people) + "people.wav" + async)
+        people = str(detected_people) + "people"
+        self._play([self._getClip(GCo.AUDIOPEOPLE, people)], GCo.AUDIOPEOPLE + people, wait,
+                   GCo.AU_PRIORITY_ANNOUNCE, key="people")
+
+    def cmdDetectionDone(self, detected_people, wait=False):
+        # "detection done" + "<n> people" compiled as one phrase
+        people = str(detected_people) + "people"
+        phrase = self._compilePhrase((self._current_language, GCo.AU_DETECTIONDONE, people),
+                                     [self._getClip(GCo.AUDIOCOMMANDS, GCo.AU_DETECTIONDONE),
+                                      self._getClip(GCo.AUDIOPEOPLE, people)],
+                                     GCo.AU_DETECTIONDONE + "+" + people)
+        self._play([phrase], GCo.AUDIOPEOPLE + people, wait, GCo.AU_PRIORITY_ANNOUNCE, key="people")
+
+    def shouldAnnounce(self, name, distance):
+        ###########################################
+        # A person already announced is only announced
+        # again after AU_IDENTITY_TTL seconds or when the
+        # distance changed by AU_IDENTITY_MOVE, a True
+        # answer records the announcement
+        ###########################################
+        now = time.time()
+        last = self._announced.pop(name, None)
+        reason = "new"
+        if last != None:
+            (announcedAt, announcedDistance) = last
+            if now - announcedAt >= GCo.AU_IDENTITY_TTL:
+                reason = "expired"
+            elif abs(distance - announcedDistance) >= GCo.AU_IDENTITY_MOVE * announcedDistance:
+                reason = "moved"
+            else:
+                self._announced[name] = last
+                self._identityStats["suppressed"] += 1
+                return False
+
+        self._announced[name] = (now, distance)
+        if len(self._announced) > GCo.AU_IDENTITY_CACHE_SIZE:
+            self._announced.popitem(last=False)
+        self._identityStats[reason] += 1
+        return True
+
+    def clearAnnouncements(self):
+        # the next sighting of everybody is announced again
+        self._announced.clear()
+
+    def getIdentityStats(self):
+        return dict(self._identityStats)
+
+    def cmdDistance(self, name, distance, wait = True, force = False):
+        if not force and not self.shouldAnnounce(name, distance):
+            print("name=", name, "already announced")
+            return
 
-    def cmdDistance(self, name, distance, wait = True):
-        async = "&"
-        if wait:
-            async=""
+        # distances are bucketed by cm through the precomputed table
+        strdist = self._distances[max(0, min(int(distance), GCo.AU_DISTANCE_TABLE_SIZE - 1))]
 
-        # play name of the user
-        self.cmdName(name,True)
+        print("name=", name, strdist)
+        # name and distance of the user played as a single gapless phrase
+        phrase = self._compilePhrase((self._current_language, name, strdist),
+                                     [self._getName(name), self._getClip(GCo.AUDIODISTANCES, strdist)],
+                                     name + "+" + strdist)
+        self._play([phrase], GCo.AUDIONAMES + name + "+" + strdist, wait,
+                   GCo.AU_PRIORITY_ANNOUNCE, key="identity:" + name)
 
-        strdist=str(int(round(distance%100/10.0))*10)
-        if distance >= 400:
-            strdist = str(distance/100) + "m"
-        elif distance < 95:
-            strdist += "cm"
-        else:
-            strdist = str(distance/100) + "m" + strdist + "cm"
+    def cmdTrainingProgress(self, progress, eta):
+        # no number clips for percentages, the "loading" prompt is repeated instead
+        print("Training progress=%d%%" % int(progress * 100), "eta=", eta)
+        self._play([self._getClip(GCo.AUDIOCOMMANDS, GCo.AU_LOADING)], GCo.AUDIOCOMMANDS + GCo.AU_LOADING, False,
+                   GCo.AU_PRIORITY_MENU, key="training")
 
-        print(strdist)
-        #play distance of the user
-        os.system(GCo.AUDIOPLAYER + " " + self._path + GCo.AUDIODISTANCES + self._languages[self._current_language] + "/" + strdist + ".wav" + async)
+    def cmdTrainingDone(self):
+        self._play([self._getClip(GCo.AUDIOCOMMANDS, GCo.AU_READY)], GCo.AUDIOCOMMANDS + GCo.AU_READY, False,
+                   GCo.AU_PRIORITY_ANNOUNCE, key="training")
+
+    def getStats(self):
+        return self._engine.getStats()
+
+    def close(self):
+        self._engine.close()
 
 
 @singleton
@@ -330,7 +1057,7 @@ class ImageManagement():
         filename = path + xfile.replace(" ","").replace(":","").replace("-","")
         cv2.imwrite(filename, frame)
         if play_sound:
-            self._audioctl.cmdSound(GCo.AU_IMAGEWRITTEN, wait=True)
+            self._audioctl.cmdSound(GCo.AU_IMAGEWRITTEN)
         return filename
 
     def calcDistance(self, x, y, h):
@@ -340,6 +1067,10 @@ class ImageManagement():
     #    offset = arctan(abs(rx-x)/distance)
         return distance
 
+    def calcFaceSize(self, distance):
+        # inverse of calcDistance, face height in pixels at distance cm
+        return (640*20)/float(distance)
+
     def markFace(self, frame, audio, name, id, det_conf, conf, x, y, h, color, position):
         distance = self.calcDistance(x,y,h)
         text = name + str(id) + ":" + "{:02d}%".format(int(conf)) +  ", " + str(distance) + "cm"
@@ -355,71 +1086,190 @@ class ImageManagement():
 
         cv2.putText(frame, text, (x+2,y+h+line), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color ,2)
         
-        if audio:
+        # one decision for the whole prompt, "unknown user" is not repeated alone
+        if audio and self._audioctl.shouldAnnounce(personName(name), distance):
            if conf < GCo.CONFIDENCE_GRADE:
-               self._audioctl.cmdSound(GCo.AU_UNKNOWNUSER, wait=True)
-           name = name.replace("hc","").replace("dnn","")
-           self._audioctl.cmdDistance(name,distance,wait=True)
+               self._audioctl.cmdAnnounce(GCo.AU_UNKNOWNUSER)
+           self._audioctl.cmdDistance(personName(name),distance,wait=False,force=True)
 
 @singleton
 class DataBase():
+    ###########################################################################
+    # Keeps a single connection open (WAL journal) and an in memory id->name
+    # map loaded on first use, recognition only does dictionary lookups.
+    # One users row per person, every dataset picture is a samples row
+    # pointing to it, recognizers are trained with the users ids.
+    ###########################################################################
     def __init__(self):
         self._cursor = None
         self._dbname = GCo.DATABASE_FILE
-        self._cursor = None
         self._path = GCo.WORKING_DIRECTORY
         self._conn = None
+        self._names = None
+        self._ids = None
+        self._batch = 0
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+
+    def afterFork(self):
+        # a forked process must not touch the parent's connection or lock
+        self._lock = threading.RLock()
+        self._conn = None
+        self._cursor = None
+        self._names = None
+        self._ids = None
+        self._batch = 0
+        self._pid = os.getpid()
 
     def _openDB(self):
-        self._conn = sqlite3.connect(self._path + self._dbname)
+        if self._pid != os.getpid():
+            self.afterFork()
+        if self._conn != None:
+            return
+        self._conn = sqlite3.connect(self._path + self._dbname, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
         self._cursor = self._conn.cursor()
+        # databases created before the samples table get it on first open
+        sql = """
+        CREATE TABLE IF NOT EXISTS users (id integer unique primary key autoincrement, name text unique);
+        CREATE TABLE IF NOT EXISTS samples (id integer unique primary key autoincrement,
+                                            user_id integer not null references users(id), detector text);
+        CREATE INDEX IF NOT EXISTS samples_user ON samples (user_id);
+        """
+        self._cursor.executescript(sql)
+        self._conn.commit()
 
     def _closeDB(self):
+        if self._conn == None:
+            return
         self._conn.commit()
         self._conn.close()
+        self._conn = None
+        self._cursor = None
 
-    def getNamesFromIds(self, ids):
-        self._openDB()
-        print("ids:",str(ids))
-        self._cursor.execute("select name from users where id = (?);", (ids,))
-#       self._cursor.execute("select name from users where id in (" + str(ids) + ");")
-        result = self._cursor.fetchall()
-        self._closeDB()
-        return result
+    def _loadNames(self):
+        with self._lock:
+            if self._names == None:
+                self._openDB()
+                try:
+                    self._cursor.execute("select id, name from users;")
+                    self._names = dict(self._cursor.fetchall())
+                except sqlite3.OperationalError:
+                    print("Warning: users table not found")
+                    self._names = {}
+                self._ids = dict([(name, id) for (id, name) in self._names.items()])
+            return self._names
 
-    def recreateDB(self):
-        print("Destruyendo y recreando base de datos")
-        os.system("rm " + self._path + self._dbname)
+    def close(self):
+        with self._lock:
+            self._closeDB()
 
-        os.system("rm " + self._path + GCo.LBP_TRAINING_FILE)
-        os.system("rm " + self._path + GCo.EIGEN_TRAINING_FILE)
-        os.system("rm " + self._path + GCo.FISHER_TRAINING_FILE)
+    def getNamesFromIds(self, ids):
+        names = self._loadNames()
+        if ids in names:
+            return [(names[ids],)]
+        return []
 
-        os.system("touch " + self._path + GCo.LBP_TRAINING_FILE)
-        os.system("touch " + self._path + GCo.EIGEN_TRAINING_FILE)
-        os.system("touch " + self._path + GCo.FISHER_TRAINING_FILE)
+    def getNamesForIds(self, ids):
+        # batch lookup for multi face frames, unknown ids map to None
+        names = self._loadNames()
+        return [names.get(id) for id in ids]
 
-        self._openDB()
-        sql = """
-        DROP TABLE IF EXISTS users;
-        CREATE TABLE users (id integer unique primary key autoincrement, name text);
-        """
-        self._cursor.executescript(sql)
-        self._closeDB()
+    def getUserId(self, name):
+        with self._lock:
+            self._loadNames()
+            return self._ids.get(name)
+
+    def recreateDB(self):
+        print("Destruyendo y recreando base de datos")
+        with self._lock:
+            self._closeDB()
+            self._names = None
+            self._ids = None
+            for suffix in ["", "-wal", "-shm"]:
+                removeFile(self._path + self._dbname + suffix)
+            removeModels(self._path)
+
+            self._openDB()
+            self._names = {}
+            self._ids = {}
         print("Base de datos fue reconstruida")
 
+    @contextlib.contextmanager
+    def transaction(self):
+        ###########################################
+        # Inserts made inside the block are committed together,
+        # or rolled back when the block raises
+        ###########################################
+        with self._lock:
+            self._openDB()
+            self._batch += 1
+            try:
+                yield
+            except:
+                self._batch -= 1
+                if self._batch == 0:
+                    self._conn.rollback()
+                    self._names = None
+                    self._ids = None
+                raise
+            self._batch -= 1
+            if self._batch == 0:
+                self._conn.commit()
+
+    def _commit(self):
+        if self._batch == 0:
+            self._conn.commit()
+
+    def clearUsers(self):
+        # inside a transaction the rows come back if the block raises
+        with self._lock:
+            self._openDB()
+            self._cursor.execute("DELETE FROM samples")
+            self._cursor.execute("DELETE FROM users")
+            # ids start from 1 again, as in a new database
+            self._cursor.execute("DELETE FROM sqlite_sequence WHERE name IN ('users', 'samples')")
+            self._names = {}
+            self._ids = {}
+            self._commit()
+
     def addUser(self, user):
-        self._openDB()
-        self._cursor.execute('INSERT INTO users (name) VALUES (?)', (user,))
-        id = self._cursor.lastrowid
-        self._closeDB()
+        # one row per person, an already known name returns its id
+        with self._lock:
+            id = self.getUserId(user)
+            if id != None:
+                return id
+            self._openDB()
+            self._cursor.execute('INSERT INTO users (name) VALUES (?)', (user,))
+            id = self._cursor.lastrowid
+            self._commit()
+            self._names[id] = user
+            self._ids[user] = id
         print("id=",id)
         return id
 
+    def addSample(self, user_id, detector):
+        with self._lock:
+            self._openDB()
+            self._cursor.execute('INSERT INTO samples (user_id, detector) VALUES (?, ?)', (user_id, detector))
+            id = self._cursor.lastrowid
+            self._commit()
+        return id
+
+    def getSampleCounts(self):
+        with self._lock:
+            self._openDB()
+            try:
+                self._cursor.execute("select user_id, count(*) from samples group by user_id;")
+                return dict(self._cursor.fetchall())
+            except sqlite3.OperationalError:
+                return {}
+
     def getNextId(self):
-        self._openDB()
-        id = self._cursor.lastrowid
-        self._closeDB()
+        with self._lock:
+            self._openDB()
+            id = self._cursor.lastrowid
         return id
 
 
@@ -488,30 +1338,30 @@ class NavigationMenu():
             self._current_command = 0
         print("Current command=", self._commands[self._current_command])
         if self._commands[self._current_command] == "detection":
-            self._audioctl.cmdSound(GCo.AU_DETECTION, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_DETECTION)
         elif self._commands[self._current_command] == "recognition":
-            self._audioctl.cmdSound(GCo.AU_RECOGNITION, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_RECOGNITION)
         elif self._commands[self._current_command] == "camara":
-            self._audioctl.cmdSound(GCo.AU_CAMERA, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_CAMERA)
         elif self._commands[self._current_command] == "method":
-            self._audioctl.cmdSound(GCo.AU_METHOD, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_METHOD)
         elif self._commands[self._current_command] == "trigger":
-            self._audioctl.cmdSound(GCo.AU_CAPTURENOW, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_CAPTURENOW)
         elif self._commands[self._current_command] == "registration":
-            self._audioctl.cmdSound(GCo.AU_REGISTRATION, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_REGISTRATION)
         elif self._commands[self._current_command] == "camara":
-            self._audioctl.cmdSound(GCo.AU_CAMARAONOFF, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_CAMARAONOFF)
 
     def previousCommand(self):
         self._current_command -= 1
         if self._current_command < 0:
             self._current_command = len(self._commands) - 1
         print("Current command=", self._commands[self._current_command])
-        self._audioctl.cmdSound(GCo.AU_LAST, wait=True)
+        self._audioctl.cmdMenu(GCo.AU_LAST)
 
     def processCommand(self):
         print("Processing command=", self._commands[self._current_command])
-        self._audioctl.cmdSound(GCo.AU_ENABLEDISABLE, wait=True)
+        self._audioctl.cmdMenu(GCo.AU_ENABLEDISABLE)
 
     def playMusic(self):
         self._audioctl.cmdSound(GCo.AU_PLAYMUSIC3)
@@ -560,7 +1410,7 @@ class NavigationMenu():
 
     def changeLanguage(self):
         self._audioctl.setNextLanguage()
-        self._audioctl.cmdSound(GCo.AU_LANGUAGE)
+        self._audioctl.cmdMenu(GCo.AU_LANGUAGE)
 
     def cameraONOFF(self):
         self._disableAll()
@@ -568,22 +1418,22 @@ class NavigationMenu():
             print("Camera and detection Disabled")
             self._force_display = True
             self._camera.setEnabled(False)
-            self._audioctl.cmdSound(GCo.AU_CAMARADISABLED, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_CAMARADISABLED)
         else:
             print("Camera Enabled")
             self._camera.setEnabled(True)
-            self._audioctl.cmdSound(GCo.AU_CAMARAENABLED, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_CAMARAENABLED)
 
     def switchMethod(self):
         if self._detection_method == GCo.HAAR_CASCADE:
             self._detection_method = GCo.DNN
-            self._audioctl.cmdSound(GCo.AU_DNNMODE, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_DNNMODE)
         elif self._detection_method == GCo.DNN:
             self._detection_method = GCo.LBP
-            self._audioctl.cmdSound(GCo.AU_LBPMODE, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_LBPMODE)
         else: # LBP Mode
             self._detection_method = GCo.HAAR_CASCADE
-            self._audioctl.cmdSound(GCo.AU_HAARCASCADEMODE, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_HAARCASCADEMODE)
 
     def triggerNow(self):
         self._trigger_flag = True
@@ -608,13 +1458,13 @@ class NavigationMenu():
             self._camera.setEnabled(False)
             self._detection_enabled = False
             self._grecognition_enabled = False
-            self._audioctl.cmdSound(GCo.AU_DETECTIONDISABLED, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_DETECTIONDISABLED)
         else:
             print("Face Detection and camera enabled")
             self._camera.setEnabled(True)
             self._recognition_enabled = False
             self._detection_enabled = True
-            self._audioctl.cmdSound(GCo.AU_DETECTIONENABLED, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_DETECTIONENABLED)
 
     def recognitionONOFF(self):
         if self._recognition_enabled:
@@ -622,13 +1472,13 @@ class NavigationMenu():
             self._recognition_enabled = False
             self._detection_enabled = False 
             self._camera.setEnabled(False)
-            self._audioctl.cmdSound(GCo.AU_RECOGNITIONDISABLED, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_RECOGNITIONDISABLED)
         else:
             print("Face Recognition = ON")
             self._camera.setEnabled(True)
             self._detection_enabled = True 
             self._recognition_enabled = True
-            self._audioctl.cmdSound(GCo.AU_RECOGNITIONENABLED, wait=True)
+            self._audioctl.cmdMenu(GCo.AU_RECOGNITIONENABLED)
 
     def processKey(self, frame, waittime, level):
         key = cv2.waitKey(waittime)
@@ -691,6 +1541,7 @@ class Registration():
             self._audioctl.cmdSound(GCo.AU_PIII, wait=True)
             name = GCo.AUDIONAMES + self._username
             os.system(GCo.AUDIORECORDER + name + " 2")
+            self._audioctl.reloadName(self._username)
             self._audioctl.cmdSound(GCo.AU_CONFIRMNAME, wait=True)
             
             while True:
@@ -733,7 +1584,10 @@ class Registration():
 
     def startRegistration(self, frame):
         print("Starting registration")
-        os.system("rm " + self._path + GCo.TEMP_DIR + "*.jpg")
+        if os.path.isdir(self._path + GCo.TEMP_DIR):
+            for image in os.listdir(self._path + GCo.TEMP_DIR):
+                if image.endswith(".jpg"):
+                    os.remove(self._path + GCo.TEMP_DIR + image)
         self._audioctl.cmdSound(GCo.AU_REGISTRATIONSTARTS, wait=True)
         username = self._captureName(frame)
         if username == "":
@@ -762,89 +1616,982 @@ class Registration():
         self._audioctl.cmdSound(GCo.AU_CAPTUREDONE, wait=True)
 
 
+class FaceCache():
+    ###########################################################################
+    # Preprocessed (gray + resized) training faces stored as .npy files keyed
+    # by the sha1 of the image file content, so retraining only decodes new or
+    # changed images. The whole cache is dropped when the grid size changes.
+    ###########################################################################
+    def __init__(self):
+        self._path = GCo.WORKING_DIRECTORY
+        self._cache_dir = self._path + GCo.FACE_CACHE_DIR
+        self._grid_file = self._cache_dir + "grid.txt"
+        self._grid = "%dx%d" % (GCo.GRIDX_SIZE, GCo.GRIDY_SIZE)
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.initialize()
+
+    def initialize(self):
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+
+        grid = ""
+        if os.path.isfile(self._grid_file):
+            with open(self._grid_file) as f:
+                grid = f.read().strip()
+
+        if grid != self._grid:
+            print("Face cache grid changed (" + grid + " -> " + self._grid + "), clearing cache")
+            self.clear()
+            with open(self._grid_file, "w") as f:
+                f.write(self._grid)
+
+        self._size = sum([os.path.getsize(entry) for entry in self._entries()])
+
+    def _entries(self):
+        return [self._cache_dir + f for f in os.listdir(self._cache_dir) if f.endswith(".npy")]
+
+    def _digest(self, image_file):
+        with open(image_file, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def _evict(self):
+        ###########################################
+        # Drop least recently used entries until the cache fits
+        ###########################################
+        entries = sorted(self._entries(), key=os.path.getmtime)
+        while self._size > GCo.FACE_CACHE_MAX_BYTES and len(entries) > 0:
+            entry = entries.pop(0)
+            self._size -= os.path.getsize(entry)
+            os.remove(entry)
+            self.evictions += 1
+
+    def clear(self):
+        for entry in self._entries():
+            os.remove(entry)
+        self._size = 0
+
+    def getSize(self):
+        return self._size
+
+    def getStats(self):
+        return {"entries": len(self._entries()), "bytes": self._size, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+    def loadFace(self, image_file, loader):
+        entry = self._cache_dir + self._digest(image_file) + ".npy"
+        if os.path.isfile(entry):
+            self.hits += 1
+            os.utime(entry, None)
+            return np.load(entry, mmap_mode='r')
+
+        self.misses += 1
+        faceNp = loader(image_file)
+        temp_entry = entry + ".tmp"
+        with open(temp_entry, "wb") as f:
+            np.save(f, faceNp)
+        os.rename(temp_entry, entry)
+        self._size += os.path.getsize(entry)
+        if self._size > GCo.FACE_CACHE_MAX_BYTES:
+            self._evict()
+        return faceNp
+
+def galleryIndexFile(model_file):
+    return os.path.splitext(model_file)[0] + "Index.npz"
+
+class GalleryIndex():
+    ###########################################################################
+    # IVF index over LBPH histograms: square rooted histograms (chi-square
+    # behaves like euclidean after it) are reduced with PCA and clustered in
+    # cv2.kmeans lists. A probe only visits the closest INDEX_PROBES lists and
+    # the INDEX_SHORTLIST nearest rows are re-ranked with the exact distance.
+    ###########################################################################
+    def __init__(self):
+        self._mean = None
+        self._components = None
+        self._centroids = None
+        self._features = None
+        self._lists = np.empty(0, dtype=np.int32)
+        self._builtSize = 0
+
+    def size(self):
+        return len(self._lists)
+
+    def _project(self, histograms):
+        return np.dot(np.sqrt(np.asarray(histograms, dtype=np.float32)) - self._mean, self._components.T)
+
+    def _fitPCA(self, data, dimensions):
+        # eigenvectors of the (samples x samples) gram matrix, histograms are
+        # much longer than the number of samples used to fit the projection
+        sample = data[np.random.RandomState(0).permutation(len(data))[:GCo.INDEX_PCA_SAMPLES]]
+        mean = sample.mean(axis=0)
+        centered = sample - mean
+        values, vectors = np.linalg.eigh(np.dot(centered, centered.T))
+        order = np.argsort(values)[::-1][:dimensions]
+        components = np.dot(centered.T, vectors[:, order]) / np.sqrt(np.maximum(values[order], 1e-12))
+        self._mean = mean[None, :].astype(np.float32)
+        self._components = np.ascontiguousarray(components.T, dtype=np.float32)
+
+    def _nearestLists(self, features):
+        distances = (features * features).sum(axis=1)[:, None] - 2.0 * np.dot(features, self._centroids.T) \
+                    + (self._centroids * self._centroids).sum(axis=1)[None, :]
+        return distances
+
+    def build(self, histograms):
+        start = time.time()
+        data = np.sqrt(np.asarray(histograms, dtype=np.float32))
+        self._fitPCA(data, min(GCo.INDEX_PCA_SIZE, len(data), data.shape[1]))
+        self._features = np.ascontiguousarray(np.dot(data - self._mean, self._components.T), dtype=np.float32)
+        lists = GCo.INDEX_LISTS
+        if lists == 0:
+            lists = int(math.sqrt(len(data)))
+        lists = max(1, min(lists, len(data)))
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, GCo.INDEX_KMEANS_ITERATIONS, 1e-3)
+        compactness, labels, self._centroids = cv2.kmeans(self._features, lists, None, criteria, 1,
+                                                          cv2.KMEANS_PP_CENTERS)
+        self._lists = labels.ravel().astype(np.int32)
+        self._builtSize = len(data)
+        end = time.time()
+        print("Gallery index build time=", end-start, "rows=", len(data), "lists=", lists)
+
+    def add(self, histograms):
+        # new rows go to their closest list, the lists are not re-clustered
+        features = self._project(histograms)
+        self._features = np.vstack([self._features, features])
+        self._lists = np.concatenate([self._lists, self._nearestLists(features).argmin(axis=1).astype(np.int32)])
+
+    def needsRebuild(self):
+        return self.size() > GCo.INDEX_REBUILD_FACTOR * self._builtSize
+
+    def search(self, histogram, shortlist):
+        feature = self._project(histogram[None, :])
+        visited = np.zeros(len(self._centroids), dtype=bool)
+        visited[np.argsort(self._nearestLists(feature)[0])[:GCo.INDEX_PROBES]] = True
+        rows = np.flatnonzero(visited[self._lists])
+        if len(rows) > shortlist:
+            distances = ((self._features[rows] - feature) ** 2).sum(axis=1)
+            rows = rows[np.argpartition(distances, shortlist - 1)[:shortlist]]
+        return rows
+
+    def load(self, index_file):
+        with open(index_file, "rb") as f:
+            data = np.load(f)
+            self._mean = data["mean"]
+            self._components = data["components"]
+            self._centroids = data["centroids"]
+            self._features = data["features"]
+            self._lists = data["lists"]
+            self._builtSize = int(data["built"][0])
+
+    def save(self, index_file):
+        temp_file = index_file + ".tmp"
+        with open(temp_file, "wb") as f:
+            np.savez(f, mean=self._mean, components=self._components, centroids=self._centroids,
+                     features=self._features, lists=self._lists, built=np.array([self._builtSize]))
+        os.rename(temp_file, index_file)
+
+class LBPHEngine():
+    ###########################################################################
+    # NumPy LBPH recognizer, a drop in replacement of cv2.face LBPHFaceRecognizer.
+    # Same circular LBP operator, grid histograms and chi-square (ALT) distance,
+    # the gallery is a single contiguous matrix scored in one broadcasted
+    # operation so the best k matches can be returned. Models are stored in the
+    # OpenCV yml format, so both backends read each other's files as long as
+    # LBPH_UNIFORM is off.
+    ###########################################################################
+    def __init__(self, radius=1, neighbors=8, grid_x=8, grid_y=8):
+        self._radius = radius
+        self._neighbors = neighbors
+        self._grid_x = grid_x
+        self._grid_y = grid_y
+        self._dtype = np.dtype(GCo.LBPH_DTYPE)
+        self._offsets = []
+        for n in range(neighbors):
+            x = np.float32(radius * math.cos(2.0 * math.pi * n / float(neighbors)))
+            y = np.float32(-radius * math.sin(2.0 * math.pi * n / float(neighbors)))
+            fx = int(math.floor(x))
+            fy = int(math.floor(y))
+            cx = int(math.ceil(x))
+            cy = int(math.ceil(y))
+            tx = np.float32(x - fx)
+            ty = np.float32(y - fy)
+            one = np.float32(1.0)
+            self._offsets.append((fx, fy, cx, cy, (one - tx) * (one - ty), tx * (one - ty), (one - tx) * ty, tx * ty))
+
+        # uniform patterns (at most two 0/1 transitions) get their own bin,
+        # every other pattern shares the last one
+        self._table = None
+        self._bins = 1 << neighbors
+        if GCo.LBPH_UNIFORM:
+            self._table = np.empty(1 << neighbors, dtype=np.int32)
+            uniform = 0
+            for code in range(1 << neighbors):
+                bits = [(code >> b) & 1 for b in range(neighbors)]
+                if sum([bits[b] != bits[(b + 1) % neighbors] for b in range(neighbors)]) <= 2:
+                    self._table[code] = uniform
+                    uniform += 1
+                else:
+                    self._table[code] = -1
+            self._table[self._table < 0] = uniform
+            self._bins = uniform + 1
+
+        self._histograms = np.empty((0, grid_x * grid_y * self._bins), dtype=self._dtype)
+        self._labels = np.empty(0, dtype=np.int32)
+        self._index = None
+
+    def _lbp(self, src):
+        src = np.asarray(src, dtype=np.float32)
+        r = self._radius
+        h = src.shape[0] - 2 * r
+        w = src.shape[1] - 2 * r
+        center = src[r:r+h, r:r+w]
+        codes = np.zeros((h, w), dtype=np.int32)
+        eps = np.finfo(np.float32).eps
+        for n, (fx, fy, cx, cy, w1, w2, w3, w4) in enumerate(self._offsets):
+            t = w1 * src[r+fy:r+fy+h, r+fx:r+fx+w] + w2 * src[r+fy:r+fy+h, r+cx:r+cx+w]
+            t = t + w3 * src[r+cy:r+cy+h, r+fx:r+fx+w] + w4 * src[r+cy:r+cy+h, r+cx:r+cx+w]
+            codes |= ((t > center) | (np.abs(t - center) < eps)).astype(np.int32) << n
+        if self._table is not None:
+            codes = self._table[codes]
+        return codes
+
+    def histogram(self, face):
+        codes = self._lbp(face)
+        cell_h = codes.shape[0] // self._grid_y
+        cell_w = codes.shape[1] // self._grid_x
+        cells = codes[:cell_h * self._grid_y, :cell_w * self._grid_x]
+        cells = cells.reshape(self._grid_y, cell_h, self._grid_x, cell_w).transpose(0, 2, 1, 3)
+        cells = cells.reshape(self._grid_y * self._grid_x, cell_h * cell_w)
+        # one bincount for the whole grid, every cell owns its own bin range
+        cells = cells + (np.arange(cells.shape[0]) * self._bins)[:, None]
+        hist = np.bincount(cells.ravel(), minlength=cells.shape[0] * self._bins).astype(np.float32)
+        return (hist / np.float32(cell_h * cell_w)).astype(self._dtype)
+
+    def train(self, faces, labels):
+        self._histograms = np.empty((0, self._histograms.shape[1]), dtype=self._dtype)
+        self._labels = np.empty(0, dtype=np.int32)
+        self._index = None
+        self.update(faces, labels)
+
+    def update(self, faces, labels):
+        added = np.vstack([self.histogram(face)[None, :] for face in faces])
+        self._histograms = np.ascontiguousarray(np.vstack([self._histograms, added]), dtype=self._dtype)
+        self._labels = np.concatenate([self._labels, np.asarray(labels, dtype=np.int32).ravel()])
+        self._updateIndex(added)
+
+    def _updateIndex(self, added):
+        if not GCo.GALLERY_INDEX_ENABLED or len(self._labels) < GCo.INDEX_MIN_SIZE:
+            self._index = None
+        elif self._index == None or self._index.size() + len(added) != len(self._labels):
+            self._index = GalleryIndex()
+            self._index.build(self._histograms)
+        elif len(added) > 0:
+            self._index.add(added)
+            if self._index.needsRebuild():
+                self._index.build(self._histograms)
+
+    def _chiSquare(self, probe, rows):
+        probe = probe.astype(np.float64)
+        result = np.empty(len(rows), dtype=np.float64)
+        for first in range(0, len(rows), GCo.LBPH_CHUNK_ROWS):
+            gallery = self._histograms[rows[first:first+GCo.LBPH_CHUNK_ROWS]].astype(np.float64)
+            diff = gallery - probe
+            total = gallery + probe
+            with np.errstate(divide='ignore', invalid='ignore'):
+                chi = np.where(total > np.finfo(np.float64).eps, diff * diff / total, 0.0)
+            result[first:first+len(gallery)] = 2.0 * chi.sum(axis=1)
+        return result
+
+    def distances(self, face):
+        return self._chiSquare(self.histogram(face), np.arange(len(self._labels)))
+
+    def predictTopK(self, face, k):
+        if len(self._labels) == 0:
+            return []
+        probe = self.histogram(face)
+        if self._index != None:
+            rows = self._index.search(probe, max(k, GCo.INDEX_SHORTLIST))
+        else:
+            rows = np.arange(len(self._labels))
+        distances = self._chiSquare(probe, rows)
+        if k == 1:
+            best = [np.argmin(distances)]
+        else:
+            # a person scores as its closest sample, k different people are returned
+            order = np.argsort(distances, kind='mergesort')
+            labels, first = np.unique(self._labels[rows[order]], return_index=True)
+            best = order[np.sort(first)[:k]]
+        return [(int(self._labels[rows[i]]), float(distances[i])) for i in best]
+
+    def predict(self, face):
+        best = self.predictTopK(face, 1)
+        if len(best) == 0:
+            return (-1, float("inf"))
+        return best[0]
+
+    def getLabels(self):
+        return self._labels.reshape(-1, 1)
+
+    def getHistograms(self):
+        return self._histograms
+
+    def read(self, model_file):
+        if not os.path.isfile(model_file) or os.path.getsize(model_file) == 0:
+            raise cv2.error("LBPH model " + model_file + " is empty")
+        fs = cv2.FileStorage(model_file, cv2.FILE_STORAGE_READ)
+        node = fs.getFirstTopLevelNode()
+        if int(node.getNode("radius").real()) != self._radius or int(node.getNode("neighbors").real()) != self._neighbors \
+                or int(node.getNode("grid_x").real()) != self._grid_x or int(node.getNode("grid_y").real()) != self._grid_y:
+            raise cv2.error("LBPH model " + model_file + " has different parameters")
+        histograms = node.getNode("histograms")
+        rows = [histograms.at(i).mat().ravel() for i in range(histograms.size())]
+        if len(rows) > 0 and len(rows[0]) != self._histograms.shape[1]:
+            raise cv2.error("LBPH model " + model_file + " has a different histogram size")
+        if len(rows) > 0:
+            self._histograms = np.ascontiguousarray(np.vstack(rows), dtype=self._dtype)
+            self._labels = node.getNode("labels").mat().ravel().astype(np.int32)
+        fs.release()
+        self._loadIndex(model_file)
+
+    def _loadIndex(self, model_file):
+        self._index = None
+        index_file = galleryIndexFile(model_file)
+        if GCo.GALLERY_INDEX_ENABLED and os.path.isfile(index_file):
+            self._index = GalleryIndex()
+            self._index.load(index_file)
+        self._updateIndex(self._histograms[len(self._histograms):])
+
+    def setGallery(self, histograms, labels, model_file):
+        # histograms may be memory mapped, they are only copied by update()
+        if len(labels) > 0 and histograms.shape[1] != self._histograms.shape[1]:
+            print("Warning: " + model_file + " has a different histogram size")
+            return False
+        if len(labels) > 0:
+            self._histograms = histograms if histograms.dtype == self._dtype else histograms.astype(self._dtype)
+            self._labels = labels
+        self._loadIndex(model_file)
+        return True
+
+    def getParameters(self):
+        return {"radius": self._radius, "neighbors": self._neighbors, "grid_x": self._grid_x, "grid_y": self._grid_y}
+
+    def save(self, model_file):
+        fs = cv2.FileStorage(model_file, cv2.FILE_STORAGE_WRITE)
+        fs.startWriteStruct("opencv_lbphfaces", cv2.FILE_NODE_MAP)
+        fs.write("threshold", sys.float_info.max)
+        fs.write("radius", self._radius)
+        fs.write("neighbors", self._neighbors)
+        fs.write("grid_x", self._grid_x)
+        fs.write("grid_y", self._grid_y)
+        fs.startWriteStruct("histograms", cv2.FILE_NODE_SEQ)
+        for histogram in self._histograms:
+            fs.write("", histogram.astype(np.float32).reshape(1, -1))
+        fs.endWriteStruct()
+        fs.write("labels", self._labels.reshape(-1, 1))
+        fs.endWriteStruct()
+        fs.release()
+
+        if self._index != None:
+            self._index.save(galleryIndexFile(model_file))
+
+def createLBPHRecognizer():
+    if GCo.LBPH_BACKEND == "numpy":
+        return LBPHEngine()
+    return cv2.face.LBPHFaceRecognizer_create()
+
+class SubspaceEngine():
+    ###########################################################################
+    # NumPy predictor of a trained Eigen or Fisher model: the probe is
+    # projected on the eigenvectors and matched to the nearest training
+    # projection (L2), as cv2.face BasicFaceRecognizer.predict does
+    ###########################################################################
+    def __init__(self, mean, eigenvectors, projections, labels):
+        self._mean = mean
+        self._eigenvectors = eigenvectors
+        self._projections = projections
+        self._labels = labels
+
+    def predict(self, face):
+        probe = np.dot(np.asarray(face, dtype=np.float64).reshape(1, -1) - self._mean, self._eigenvectors)
+        distances = np.sqrt(((self._projections - probe) ** 2).sum(axis=1))
+        best = int(np.argmin(distances))
+        return (int(self._labels[best]), float(distances[best]))
+
+    def getLabels(self):
+        return np.asarray(self._labels).reshape(-1, 1)
+
+###########################################################################
+# Binary snapshots: every model saved to yml also gets <model>.snap, a small
+# json header (kind, parameters, stat of the yml it mirrors) and one
+# <model>.<array>.npy file per matrix, loaded memory mapped at boot. The
+# yml files remain the export format and the fallback when a snapshot
+# is missing or older than its yml.
+###########################################################################
+def snapshotFile(model_file, array=None):
+    base = os.path.splitext(model_file)[0]
+    if array == None:
+        return base + ".snap"
+    return base + "." + array + ".npy"
+
+def removeSnapshot(model_file):
+    for array in ["histograms", "labels", "mean", "eigenvectors", "projections"]:
+        removeFile(snapshotFile(model_file, array))
+    removeFile(snapshotFile(model_file))
+
+def writeSnapshot(recognizer, model_file):
+    if isinstance(recognizer, LBPHEngine):
+        kind = "lbph"
+        params = recognizer.getParameters()
+        arrays = {"histograms": recognizer.getHistograms(), "labels": recognizer.getLabels()}
+    elif hasattr(recognizer, "getHistograms"):
+        kind = "lbph"
+        params = {"radius": recognizer.getRadius(), "neighbors": recognizer.getNeighbors(),
+                  "grid_x": recognizer.getGridX(), "grid_y": recognizer.getGridY()}
+        histograms = recognizer.getHistograms()
+        arrays = {"histograms": np.vstack(histograms) if len(histograms) > 0 else np.empty((0, 0), np.float32),
+                  "labels": recognizer.getLabels()}
+    else:
+        kind = "subspace"
+        params = {}
+        arrays = {"mean": recognizer.getMean(), "eigenvectors": recognizer.getEigenVectors(),
+                  "projections": np.vstack(recognizer.getProjections()), "labels": recognizer.getLabels()}
+
+    for (array, value) in arrays.items():
+        temp_file = snapshotFile(model_file, array) + ".tmp"
+        with open(temp_file, "wb") as f:
+            np.save(f, np.ascontiguousarray(value))
+        os.rename(temp_file, snapshotFile(model_file, array))
+
+    # the header is written last, a snapshot without it is never read
+    stat = os.stat(model_file)
+    header = {"kind": kind, "params": params, "arrays": sorted(arrays.keys()),
+              "source": [stat.st_size, stat.st_mtime]}
+    temp_file = snapshotFile(model_file) + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump(header, f)
+    os.rename(temp_file, snapshotFile(model_file))
+
+def readSnapshot(model_file):
+    ###########################################
+    # Returns a numpy predictor built from the snapshot of
+    # model_file, None when there is no valid snapshot
+    ###########################################
+    try:
+        with open(snapshotFile(model_file)) as f:
+            header = json.load(f)
+        stat = os.stat(model_file)
+        if header["source"] != [stat.st_size, stat.st_mtime]:
+            print("Snapshot of " + model_file + " is older than the yml file")
+            return None
+        arrays = dict([(array, np.load(snapshotFile(model_file, array), mmap_mode='r'))
+                       for array in header["arrays"]])
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+    labels = np.asarray(arrays["labels"]).ravel().astype(np.int32)
+    if header["kind"] == "lbph":
+        params = header["params"]
+        recognizer = LBPHEngine(params["radius"], params["neighbors"], params["grid_x"], params["grid_y"])
+        if not recognizer.setGallery(arrays["histograms"], labels, model_file):
+            return None
+        return recognizer
+    return SubspaceEngine(arrays["mean"], arrays["eigenvectors"], arrays["projections"], labels)
+
+def saveModel(recognizer, model_file, backend):
+    # only readModel() with the numpy backend reads the snapshot back
+    recognizer.save(model_file)
+    if GCo.MODEL_SNAPSHOTS and backend == "numpy":
+        start = time.time()
+        writeSnapshot(recognizer, model_file)
+        print("Snapshot write time=", time.time() - start)
+    else:
+        removeSnapshot(model_file)
+
+def readModel(create, model_file, backend):
+    ###########################################
+    # Snapshots load as numpy engines, so they are only
+    # read with the numpy backend, the yml file otherwise
+    # (a snapshot of it is written so the next boot is fast)
+    ###########################################
+    snapshots = GCo.MODEL_SNAPSHOTS and backend == "numpy"
+    if snapshots:
+        recognizer = readSnapshot(model_file)
+        if recognizer != None:
+            return recognizer
+
+    recognizer = create()
+    recognizer.read(model_file)
+    if snapshots:
+        writeSnapshot(recognizer, model_file)
+    return recognizer
+
 class Trainer():
     def __init__(self):
         self._db = DataBase()
         self._path = GCo.WORKING_DIRECTORY
-        self._dataset = self._path + 'dataset'
-        self._LBPRecognizer = cv2.face.LBPHFaceRecognizer_create()
+        self._dataset = self._path + GCo.DATASET_DIR
+        self._staging = self._path + GCo.DATASET_STAGING_DIR
+        self._old = self._path + GCo.DATASET_OLD_DIR
+        self._LBPRecognizer = createLBPHRecognizer()
         self._EigenRecognizer = cv2.face.EigenFaceRecognizer_create()
         self._FisherRecognizer = cv2.face.FisherFaceRecognizer_create()
+        self._LBPCoarseRecognizer = createLBPHRecognizer()
+        self._trained = {}
+        self._faceCache = FaceCache()
+        self._recoverDataset()
+
+    def _decodeFace(self, image_file):
+        faceImg = Image.open(image_file).convert('L')
+        faceNp = np.array(faceImg,'uint8')
+        return cv2.resize(faceNp,(GCo.GRIDX_SIZE, GCo.GRIDY_SIZE))
+
+    def _loadFace(self, image_file):
+        return self._faceCache.loadFace(image_file, self._decodeFace)
+
+    def _modelFile(self, model_file, version=None):
+        if version == None:
+            version = readModelVersion(self._path)
+        return self._path + modelFile(model_file, version)
+
+    def _coarseFaces(self, faces):
+        size = (GCo.COARSE_GRID_SIZE, GCo.COARSE_GRID_SIZE)
+        return [cv2.resize(face, size, interpolation=cv2.INTER_AREA) for face in faces]
+
+    def _updateLBPModel(self, recognizer, model_file, faces, ids):
+        ###########################################
+        # Incremental enrollment needs the current model in memory,
+        # it is trained from scratch when there is no model yet
+        ###########################################
+        if not self._trained.get(model_file, False):
+            if os.path.isfile(model_file) and os.path.getsize(model_file) > 0:
+                recognizer.read(model_file)
+                self._trained[model_file] = True
+
+        if self._trained.get(model_file, False):
+            recognizer.update(faces, ids)
+        else:
+            recognizer.train(faces, ids)
+            self._trained[model_file] = True
+        saveModel(recognizer, model_file, GCo.LBPH_BACKEND)
+
+    def _recoverDataset(self):
+        ###########################################
+        # Finish or undo a dataset swap interrupted by a crash,
+        # the staging dir is only promoted after the db commit
+        ###########################################
+        if not os.path.isdir(self._dataset) and os.path.isdir(self._old):
+            if os.path.isdir(self._staging):
+                print("Recovering dataset from " + self._staging)
+                os.rename(self._staging, self._dataset)
+            else:
+                print("Recovering dataset from " + self._old)
+                os.rename(self._old, self._dataset)
+        if os.path.isdir(self._old):
+            shutil.rmtree(self._old)
+        if os.path.isdir(self._staging):
+            shutil.rmtree(self._staging)
+
+    def _stageFile(self, image_file, new_name):
+        # hard links cost no data copy and keep dataset/ untouched until the swap
+        try:
+            os.link(image_file, new_name)
+        except OSError:
+            shutil.copy2(image_file, new_name)
 
     def _datasetRebuild(self):
-        dataset_directory = [os.path.join(self._dataset,f) for f in os.listdir(self._dataset)]
+        ###########################################
+        # The renamed dataset is built in a staging dir and all
+        # the db rows (cleared and refilled) in one transaction,
+        # dataset/ is only replaced once both are complete
+        ###########################################
+        self._recoverDataset()
+        os.makedirs(self._staging)
         faces = []
         ids = []
-        workdir = GCo.TEMP_DIR
-        os.system("mkdir " + workdir)
-        for image_file in dataset_directory:
-            faceImg = Image.open(image_file).convert('L')
-            faceNp = np.array(faceImg,'uint8')
-            faceNp = cv2.resize(faceNp,(GCo.GRIDX_SIZE, GCo.GRIDY_SIZE))
-            faces.append(faceNp)
+        with self._db.transaction():
+            self._db.clearUsers()
+            for image in sorted(os.listdir(self._dataset)):
+                image_file = os.path.join(self._dataset, image)
+                filename = image.split('.')
+                if len(filename) != 3 or filename[2] != "jpg":
+                    self._stageFile(image_file, self._staging + image)
+                    continue
 
-            #cv2.imshow("FaceDemo", faceNp)
-            #key = cv2.waitKey(200)
+                faceNp = self._loadFace(image_file)
+                faces.append(faceNp)
 
-            #print(image_file)
-            filename = os.path.split(image_file)[-1].split('.')
+                # <person><detector>.<sample id>.jpg, the label is the person id
+                name = personName(filename[0])
+                id = self._db.addUser(name)
+                ids.append(id)
+                sample = self._db.addSample(id, filename[0][len(name):])
+                new_name = self._staging + filename[0] + "." + str(sample) + "." + filename[2]
+                self._stageFile(image_file, new_name)
 
-            id = self._db.addUser(filename[0])
-            ids.append(id)
-            new_name = workdir + filename[0] + "." + str(id) + "." + filename[2]
-            #print("oldname: " + image_file + ". new name: " + new_name)
-            os.system("mv " + image_file + " " + new_name)
+        os.rename(self._dataset, self._old)
+        os.rename(self._staging, self._dataset)
+        shutil.rmtree(self._old)
 
-        #cv2.imclose("FaceDemo")
-        #cv2.destroyAllWindows()
-            
-        os.system("mv " + workdir + "* " + self._dataset)
-#        os.system("rmdir " + workdir)
+        print("Face cache:", self._faceCache.getStats())
+        return np.array(ids), faces
+
+    def addUserToDB(self, user):
+        ###########################################
+        # Move the registration pictures of user into the dataset,
+        # every picture is a sample of the same db user
+        ###########################################
+        faces = []
+        ids = []
+        moves = []
+        names = [user + "dnn", user + "hc", user + "lbp"]
+        with self._db.transaction():
+            for image in sorted(os.listdir(self._path + GCo.TEMP_DIR)):
+                filename = image.split('.')
+                if len(filename) != 3 or filename[0] not in names:
+                    continue
+
+                image_file = self._path + GCo.TEMP_DIR + image
+                faces.append(self._loadFace(image_file))
+                id = self._db.addUser(user)
+                ids.append(id)
+                sample = self._db.addSample(id, filename[0][len(user):])
+                moves.append((image_file, self._dataset + filename[0] + "." + str(sample) + "." + filename[2]))
+
+        for (image_file, new_name) in moves:
+            os.rename(image_file, new_name)
 
         return np.array(ids), faces
 
-    def addUserToDB(self, user, uid):
-        for lcounter in range (1, GCo.MAX_REG_PICTURES+1):
-            os.system("mv " + GCo.TEMP_DIR + user + "dnn.%d.jpg dataset/%s.%d.jpg"%(lcounter,user+"dnn",uid))
-            os.system("mv " + GCo.TEMP_DIR + user + "hc.%d.jpg dataset/%s.%d.jpg"%(lcounter,user+"hc",uid))
-            os.system("mv " + GCo.TEMP_DIR + user + "lbp.%d.jpg dataset/%s.%d.jpg"%(lcounter,user+"lbp",uid))
-        return 0
+    def enrollUser(self, user):
+        ###########################################
+        # Incremental enrollment: only the new pictures are added to
+        # the db and the LBP model, trainAll() remains as the full
+        # maintenance rebuild
+        ###########################################
+        ids, faces = self.addUserToDB(user)
+        print(user, "enrolled pictures=", len(ids))
+        if len(ids) == 0:
+            return ids, faces
 
-    def trainAll(self):
-        self._db.recreateDB()
-        print("reentrenando base de datos")
-        ids, faces = self._datasetRebuild()
-        print(len(ids), len(faces))
+        if GCo.LBP_ENABLED:
+            start = time.time()
+            print("LBP update starts")
+            self._updateLBPModel(self._LBPRecognizer, self._modelFile(GCo.LBP_TRAINING_FILE), faces, ids)
+            if GCo.MULTIRES_ENABLED:
+                self._updateLBPModel(self._LBPCoarseRecognizer, self._modelFile(GCo.LBP_COARSE_TRAINING_FILE),
+                                     self._coarseFaces(faces), ids)
+            print("LBP update done")
+            end = time.time()
+            print("LBP Update time=", end-start)
+
+        if (GCo.EIGEN_ENABLED or GCo.FISHER_ENABLED) and not GCo.BACKGROUND_TRAINING:
+            # Eigen and Fisher models can not be updated, only retrained
+            print("Warning: Eigen/Fisher models are refreshed by a full rebuild (python main.py --rebuild)")
+
+        return ids, faces
+
+    def _loadDataset(self, progress=None):
+        ###########################################
+        # Dataset faces labelled with the current db users,
+        # read only so it can run next to the main process
+        ###########################################
+        images = [image for image in sorted(os.listdir(self._dataset)) if image.endswith(".jpg")]
+        faces = []
+        ids = []
+        for n, image in enumerate(images):
+            id = self._db.getUserId(personName(image.split('.')[0]))
+            if id == None:
+                print("Warning: " + image + " not in the db, run python main.py --rebuild")
+                continue
+            faces.append(self._loadFace(self._dataset + image))
+            ids.append(id)
+            if progress != None and n % 16 == 0:
+                progress(0.5 * n / len(images))
+        return np.array(ids), faces
+
+    def _trainModels(self, ids, faces, version, progress=None):
+        stages = [GCo.EIGEN_ENABLED, GCo.FISHER_ENABLED, GCo.LBP_ENABLED, GCo.LBP_ENABLED and GCo.MULTIRES_ENABLED]
+        stages = max(1, len([stage for stage in stages if stage]))
+        done = [0]
+        def stageDone():
+            done[0] += 1
+            if progress != None:
+                progress(0.5 + 0.5 * done[0] / stages)
 
         if GCo.EIGEN_ENABLED:
             start = time.time()
             print("Eigen training starts")
             self._EigenRecognizer.train(faces, ids)
-            self._EigenRecognizer.save(self._path + GCo.EIGEN_TRAINING_FILE)
+            saveModel(self._EigenRecognizer, self._modelFile(GCo.EIGEN_TRAINING_FILE, version), GCo.SUBSPACE_BACKEND)
             print("Eigen training done")
             end = time.time()
             print("Eigen Training time=", end-start)
+            stageDone()
 
-        if GCo.FISHER_ENABLED:
+        if GCo.FISHER_ENABLED and len(set(ids)) < 2:
+            print("Warning: Fisher needs at least two people, training skipped")
+            stageDone()
+        elif GCo.FISHER_ENABLED:
             start = time.time()
             start = time.time()
             self._FisherRecognizer.train(faces, ids)
-            self._FisherRecognizer.save(self._path + GCo.FISHER_TRAINING_FILE)
+            saveModel(self._FisherRecognizer, self._modelFile(GCo.FISHER_TRAINING_FILE, version), GCo.SUBSPACE_BACKEND)
             print("Fisher training done")
             end = time.time()
             print("Fisher Training time=", end-start)
+            stageDone()
 
         if GCo.LBP_ENABLED:
             start = time.time()
             print("LBP training starts")
+            lbp_file = self._modelFile(GCo.LBP_TRAINING_FILE, version)
             self._LBPRecognizer.train(faces, ids)
-            self._LBPRecognizer.save(self._path + GCo.LBP_TRAINING_FILE)
+            self._trained[lbp_file] = True
+            saveModel(self._LBPRecognizer, lbp_file, GCo.LBPH_BACKEND)
             print("LBP training done")
             end = time.time()
             print("LBP Training time=", end-start)
+            stageDone()
 
+        if GCo.LBP_ENABLED and GCo.MULTIRES_ENABLED:
+            start = time.time()
+            print("LBP coarse training starts")
+            coarse_file = self._modelFile(GCo.LBP_COARSE_TRAINING_FILE, version)
+            self._LBPCoarseRecognizer.train(self._coarseFaces(faces), ids)
+            self._trained[coarse_file] = True
+            saveModel(self._LBPCoarseRecognizer, coarse_file, GCo.LBPH_BACKEND)
+            end = time.time()
+            print("LBP coarse Training time=", end-start)
+            stageDone()
+
+    def trainAll(self):
+        print("reentrenando base de datos")
+        ids, faces = self._datasetRebuild()
+        # the old models point to the ids the rebuild renumbered
+        removeModels(self._path)
+        print(len(ids), len(faces), "people=", len(set(ids)))
+        self._trainModels(ids, faces, 0)
         print("base de datos reentrenada")
 
+    def trainModels(self, version, progress=None):
+        ###########################################
+        # Retrain every model from the dataset into a new version,
+        # the db is not modified and the models in use stay untouched.
+        # The version file is written by whoever swaps the models in,
+        # returns False when there was nothing to train
+        ###########################################
+        ids, faces = self._loadDataset(progress)
+        print(len(ids), len(faces), "people=", len(set(ids)))
+        if len(ids) == 0:
+            return False
+        self._trainModels(ids, faces, version, progress)
+        return True
+
+def trainingProcess(version, messages):
+    # entry point of the training process, reports back through messages
+    DataBase().afterFork()
+    start = time.time()
+    def progress(fraction):
+        messages.put(("progress", fraction, time.time() - start))
+    try:
+        if not Trainer().trainModels(version, progress):
+            # no model files were written for this version
+            version = None
+        messages.put(("done", version, time.time() - start))
+    except Exception as e:
+        messages.put(("failed", str(e), time.time() - start))
+
+class TrainingWorker():
+    ###########################################################################
+    # Runs Trainer.trainModels() in a separate process so the main loop keeps
+    # answering keypad and audio. poll() is called from the main loop, it
+    # forwards progress (fraction, eta seconds) and the finished version to
+    # the hooks. An enrollment during training schedules one more run, which
+    # trains the next version even if the previous one is not swapped in yet.
+    # A version finished while a run is pending misses those samples, it is
+    # not reported: the live models already have them through enrollFaces().
+    ###########################################################################
+    def __init__(self, onProgress=None, onDone=None):
+        self._path = GCo.WORKING_DIRECTORY
+        self._process = None
+        self._messages = None
+        self._pending = False
+        self._onProgress = onProgress
+        self._onDone = onDone
+        self.version = readModelVersion(self._path)
+        self.progress = 0.0
+        self.eta = None
+
+    def isRunning(self):
+        return self._process != None
+
+    def start(self):
+        if self.isRunning():
+            self._pending = True
+            return False
+
+        self.version = max(self.version, readModelVersion(self._path))
+        self.progress = 0.0
+        self.eta = None
+        self._messages = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=trainingProcess, args=(self.version + 1, self._messages))
+        self._process.daemon = True
+        self._process.start()
+        print("Training process started, version=", self.version + 1)
+        return True
+
+    def _finish(self):
+        self._process.join()
+        self._process = None
+        self._messages = None
+
+    def poll(self):
+        while self._process != None:
+            try:
+                message = self._messages.get_nowait()
+            except queue.Empty:
+                if not self._process.is_alive() and self._messages.empty():
+                    print("Warning: training process exited with code", self._process.exitcode)
+                    self._finish()
+                    self._startPending()
+                return
+
+            if message[0] == "progress":
+                (kind, self.progress, elapsed) = message
+                if self.progress > 0:
+                    self.eta = elapsed * (1.0 - self.progress) / self.progress
+                if self._onProgress != None:
+                    self._onProgress(self.progress, self.eta)
+            elif message[0] == "done":
+                (kind, version, elapsed) = message
+                print("Training process done, version=", version, "time=", elapsed)
+                self._finish()
+                if version != None:
+                    self.version = version
+                    if self._onDone != None and not self._pending:
+                        self._onDone(version)
+                self._startPending()
+            else:
+                print("Warning: training process failed:", message[1])
+                self._finish()
+                self._startPending()
+
+    def _startPending(self):
+        if self._pending:
+            self._pending = False
+            self.start()
+
+    def close(self):
+        if self._process != None:
+            self._process.terminate()
+            self._finish()
+
+def toFaces(detections, det_conf=100):
+    # cascade detectors return (x,y,w,h) boxes, dnn already returns GCo.FACE_DTYPE
+    if detections is None:
+        return np.empty(0, dtype=GCo.FACE_DTYPE)
+    if isinstance(detections, np.ndarray) and detections.dtype == GCo.FACE_DTYPE:
+        return detections
+    boxes = np.array(detections, dtype=np.int32).reshape(-1, 4)
+    faces = np.empty(len(boxes), dtype=GCo.FACE_DTYPE)
+    faces["x"], faces["y"], faces["w"], faces["h"] = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    faces["conf"] = det_conf
+    return faces
+
+class CascadePlanner():
+    ###########################################################################
+    # Plans the detectMultiScale calls of a cascade: the face sizes searched
+    # come from DETECTION_MIN/MAX_DISTANCE through the calcDistance model, the
+    # frame is reduced while the farthest face still fills the cascade window
+    # and the regions around recent detections are scanned before falling
+    # back to a full frame scan.
+    ###########################################################################
+    def __init__(self, cascade):
+        self._cascade = cascade
+        self._window = max(cascade.getOriginalWindowSize())
+        self._im = ImageManagement()
+        self._previous = []
+        self._previousTime = 0
+        self._roiScans = 0
+        self._stats = {"full": 0, "roi": 0, "fallback": 0, "time": 0.0}
+
+    def getStats(self):
+        return dict(self._stats)
+
+    def faceSizes(self):
+        # face heights of the supported distance range, with the model tolerance
+        return (self._im.calcFaceSize(GCo.DETECTION_MAX_DISTANCE) * (1 - GCo.CASCADE_SIZE_MARGIN),
+                self._im.calcFaceSize(GCo.DETECTION_MIN_DISTANCE) * (1 + GCo.CASCADE_SIZE_MARGIN))
+
+    def _scan(self, gray, region, minFace, maxFace, scale):
+        ###########################################
+        # The region is reduced as much as the smallest face
+        # allows (or the requested scale), boxes are returned
+        # in frame coordinates
+        ###########################################
+        (x, y, w, h) = region
+        scale = min(scale, 1.0, self._window / float(minFace))
+        minSize = max(self._window, int(minFace * scale))
+        maxSize = min(int(maxFace * scale), int(w * scale), int(h * scale))
+        if maxSize < minSize:
+            return np.empty((0, 4), dtype=np.int32)
+
+        image = gray[y:y+h, x:x+w]
+        if scale < 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        faces = self._cascade.detectMultiScale(image, scaleFactor=GCo.CASCADE_SCALE_FACTOR,
+                                               minNeighbors=GCo.CASCADE_MIN_NEIGHBORS,
+                                               minSize=(minSize, minSize), maxSize=(maxSize, maxSize))
+        if len(faces) == 0:
+            return np.empty((0, 4), dtype=np.int32)
+        return (np.array(faces) / scale).astype(np.int32) + np.array([x, y, 0, 0], dtype=np.int32)
+
+    def _regions(self, gray):
+        # previous boxes grown by CASCADE_ROI_MARGIN on every side
+        (height, width) = gray.shape[:2]
+        for (x, y, w, h) in self._previous:
+            mx, my = int(w * GCo.CASCADE_ROI_MARGIN), int(h * GCo.CASCADE_ROI_MARGIN)
+            (x1, y1) = (max(x - mx, 0), max(y - my, 0))
+            (x2, y2) = (min(x + w + mx, width), min(y + h + my, height))
+            yield (x1, y1, x2 - x1, y2 - y1), h
+
+    def detect(self, gray, scale=1.0):
+        start = time.time()
+        (minFace, maxFace) = self.faceSizes()
+        faces = None
+
+        recent = time.time() - self._previousTime <= GCo.CASCADE_ROI_MAX_AGE
+        if len(self._previous) > 0 and recent and self._roiScans < GCo.CASCADE_FULL_SCAN_EVERY:
+            # a face can come closer or move away a bit between detections
+            found = [self._scan(gray, region, max(minFace, h / 1.5), min(maxFace, h * 1.5), scale)
+                     for (region, h) in self._regions(gray)]
+            faces = np.concatenate(found)
+            if len(faces) > 1:
+                # overlapped regions find the same face twice
+                keep = cv2.dnn.NMSBoxes(faces.tolist(), [1.0] * len(faces), 0.5, 0.3)
+                faces = faces[np.array(keep, dtype=np.int32).flatten()]
+            self._roiScans += 1
+            self._stats["roi"] += 1
+            if len(faces) < len(self._previous):
+                self._stats["fallback"] += 1
+                faces = None
+
+        if faces is None:
+            (height, width) = gray.shape[:2]
+            faces = self._scan(gray, (0, 0, width, height), minFace, maxFace, scale)
+            self._roiScans = 0
+            self._stats["full"] += 1
+
+        self._previous = faces.tolist()
+        self._previousTime = time.time()
+        self._stats["time"] += time.time() - start
+        if len(faces) == 0:
+            # same as detectMultiScale when nothing is found
+            return ()
+        return faces
+
 class BaseDetector():
     def __init__(self):
         self.path = GCo.WORKING_DIRECTORY
@@ -879,27 +2626,43 @@ class BaseDetector():
     def getRegistrationsNumber(self):
         return len(self.regFaces)
 
+    def _detectMultiScale(self, gray, scale, planned):
+        if planned and GCo.CASCADE_PLANNING:
+            return self._planner.detect(gray, scale)
+
+        # a reduced copy is scanned, the boxes come back in frame coordinates
+        if scale >= 1.0:
+            return self._face_cascade.detectMultiScale(gray, 1.3, 5)
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        faces = self._face_cascade.detectMultiScale(small, 1.3, 5)
+        if len(faces) == 0:
+            return faces
+        return (faces / scale).astype(np.int32)
+
 class HaarCascadeDetector(BaseDetector):
     def __init__(self):
         BaseDetector.__init__(self)
         self._classifier_file = self.path + GCo.CLASSIFIER_FILE
         self._face_cascade = None
+        self._planner = None
         self.initialize()
 
     def isDetectorValid(self):
         return (self._face_cascade != None)
 
     def initialize(self):
-        os.system("mkdir " + self._temp_dir)
+        if not os.path.isdir(self._temp_dir):
+            os.makedirs(self._temp_dir)
         self.color = (0, 255, 0)
         if os.path.isfile(self._classifier_file):
             self._face_cascade = cv2.CascadeClassifier(self._classifier_file)
+            self._planner = CascadePlanner(self._face_cascade)
 
-    def faceDetection(self, frame, gray):
+    def faceDetection(self, frame, gray, scale=1.0, planned=True):
         start = time.time()
         self.people_detected = 0
         self.audio = True
-        self.faces = self._face_cascade.detectMultiScale(gray, 1.3, 5)
+        self.faces = self._detectMultiScale(gray, scale, planned)
         end = time.time()
         print("HAAR CASCADE Face Detection time=", end-start)
         return self.faces
@@ -950,22 +2713,25 @@ class LBPDetector(BaseDetector):
         BaseDetector.__init__(self)
         self._classifier_file = self.path + GCo.LBP_CLASSIFIER_FILE
         self._face_cascade = None
+        self._planner = None
         self.initialize()
 
     def isDetectorValid(self):
         return (self._face_cascade != None)
 
     def initialize(self):
-        os.system("mkdir " + self._temp_dir)
+        if not os.path.isdir(self._temp_dir):
+            os.makedirs(self._temp_dir)
         self.color = (255, 0, 0)
         if os.path.isfile(self._classifier_file):
             self._face_cascade = cv2.CascadeClassifier(self._classifier_file)
+            self._planner = CascadePlanner(self._face_cascade)
 
-    def faceDetection(self, frame, gray):
+    def faceDetection(self, frame, gray, scale=1.0, planned=True):
         start = time.time()
         self.people_detected = 0
         self.audio = True
-        self.faces = self._face_cascade.detectMultiScale(gray, 1.3, 5)
+        self.faces = self._detectMultiScale(gray, scale, planned)
         end = time.time()
         print("LBP Face Detection time=", end-start)
         return self.faces
@@ -1018,47 +2784,109 @@ class DnnDetector(BaseDetector):
         return (self._net != None)
 
     def initialize(self):
-        os.system("mkdir " + self._temp_dir)
+        if not os.path.isdir(self._temp_dir):
+            os.makedirs(self._temp_dir)
         self.color = (0, 255, 255)
         if os.path.isfile(self._prototxt) and os.path.isfile(self._model):
             self._net = cv2.dnn.readNetFromCaffe(self._prototxt, self._model)
 
-    def faceDetection(self, frame, gray):
-        start = time.time()
-        blob = cv2.dnn.blobFromImage(frame, 1.0, (GCo.GRIDX_SIZE, GCo.GRIDY_SIZE), (104.0, 177.0, 123.0))
+    def _extractFaces(self, detections, width, height, xoffset=0, yoffset=0):
+        ###########################################
+        # Keep the candidates over the confidence grade, scale and
+        # clip their boxes to the frame, all as whole array operations
+        ###########################################
+        detections = detections[detections[:, 2] >= GCo.CONFIDENCE_GRADE]
+        scale = np.array([width, height, width, height], dtype=np.float32)
+        boxes = np.clip(detections[:, 3:7] * scale, 0, scale - 1).astype(np.int32)
+        w = boxes[:, 2] - boxes[:, 0]
+        h = boxes[:, 3] - boxes[:, 1]
+        valid = (w > 0) & (h > 0)
+        boxes, w, h = boxes[valid], w[valid], h[valid]
+
+        faces = np.empty(len(boxes), dtype=GCo.FACE_DTYPE)
+        faces["x"] = boxes[:, 0] + (w >> 2) + xoffset
+        faces["y"] = boxes[:, 1] + yoffset
+        faces["w"] = w
+        faces["h"] = h
+        faces["conf"] = detections[valid, 2] * 100
+        return faces
+
+    def _suppressFaces(self, faces, threshold):
+        # non maximum suppression of overlapped boxes
+        if threshold <= 0 or len(faces) < 2:
+            return faces
+        rects = np.stack([faces["x"], faces["y"], faces["w"], faces["h"]], axis=1).tolist()
+        keep = np.array(cv2.dnn.NMSBoxes(rects, faces["conf"].tolist(), GCo.CONFIDENCE_GRADE * 100,
+                                         threshold), dtype=np.int32).flatten()
+        return faces[keep]
+
+    def _tiles(self, width, height):
+        ###########################################
+        # Full frame plus a grid of overlapped tiles, small and
+        # distant faces get more pixels of the network input
+        ###########################################
+        tiles = [(0, 0, width, height)]
+        tile_w = int(width / (GCo.DNN_TILES_X - (GCo.DNN_TILES_X - 1) * GCo.DNN_TILE_OVERLAP))
+        tile_h = int(height / (GCo.DNN_TILES_Y - (GCo.DNN_TILES_Y - 1) * GCo.DNN_TILE_OVERLAP))
+        for j in range(GCo.DNN_TILES_Y):
+            for i in range(GCo.DNN_TILES_X):
+                x = (width - tile_w) * i // max(GCo.DNN_TILES_X - 1, 1)
+                y = (height - tile_h) * j // max(GCo.DNN_TILES_Y - 1, 1)
+                tiles.append((x, y, tile_w, tile_h))
+        return tiles
+
+    def _forward(self, images, scale=1.0):
+        # all images go through the network in a single forward pass
+        size = (int(GCo.DNN_INPUT_SIZE * scale), int(GCo.DNN_INPUT_SIZE * scale))
+        if len(images) == 1:
+            blob = cv2.dnn.blobFromImage(images[0], 1.0, size, GCo.DNN_MEAN)
+        else:
+            blob = cv2.dnn.blobFromImages(images, 1.0, size, GCo.DNN_MEAN)
         self._net.setInput(blob)
-        dnnDetections = self._net.forward()
-        lfaces = 0
+        return self._net.forward()
+
+    def faceDetectionBatch(self, frames):
+        ###########################################
+        # Several frames (i.e. the camera ring buffer) in one
+        # forward pass, returns the faces of every frame
+        ###########################################
+        start = time.time()
+        detections = self._forward(frames)[0, 0]
+        results = []
+        for index, frame in enumerate(frames):
+            (height, width) = frame.shape[:2]
+            faces = self._extractFaces(detections[detections[:, 0] == index], width, height)
+            results.append(self._suppressFaces(faces, GCo.DNN_NMS_THRESHOLD))
+        end = time.time()
+        print("DNN Batch Face Detection time=", end-start, "frames=", len(frames))
+        return results
+
+    def faceDetectionTiled(self, frame):
+        (height, width) = frame.shape[:2]
+        tiles = self._tiles(width, height)
+        detections = self._forward([frame[y:y+h, x:x+w] for (x, y, w, h) in tiles])[0, 0]
+        faces = [self._extractFaces(detections[detections[:, 0] == index], w, h, x, y)
+                 for index, (x, y, w, h) in enumerate(tiles)]
+        # faces found twice (tile overlaps and full frame) are merged
+        return self._suppressFaces(np.concatenate(faces), max(GCo.DNN_NMS_THRESHOLD, 0.3))
+
+    def faceDetection(self, frame, gray, scale=1.0):
+        start = time.time()
         self.people_detected = 0
-        self.faces = []
 
         ###########################################
         # Extact what current faces
         ###########################################
-        if dnnDetections != None:
-            self.audio = True
-            for i in range(0, dnnDetections.shape[2]):
-                ###########################################
-                # Get confidence level and skip candidates with < 50%
-                ###########################################
-                confidence = dnnDetections[0, 0, i, 2]
-
-                if confidence < GCo.CONFIDENCE_GRADE:
-                    continue
-
-                lfaces += 1
-
-                ###########################################
-                # calculate face box dimensions
-                ###########################################
-                box = dnnDetections[0, 0, i, 3:7] * np.array([GCo.DISPLAYX_SIZE, GCo.DISPLAYY_SIZE, GCo.DISPLAYX_SIZE, GCo.DISPLAYY_SIZE])
-                (x1, y1, x2, y2) = box.astype("int")
-
-                w = x2-x1
-                h = y2-y1
-                self.faces.append((x1+(w>>2),y1,w,h,confidence*100))
+        if GCo.DNN_TILED_MODE:
+            self.faces = self.faceDetectionTiled(frame)
+        else:
+            (height, width) = frame.shape[:2]
+            dnnDetections = self._forward([frame], scale)
+            self.faces = self._extractFaces(dnnDetections[0, 0], width, height)
+            self.faces = self._suppressFaces(self.faces, GCo.DNN_NMS_THRESHOLD)
 
-        self.people_detected = lfaces
+        self.audio = True
+        self.people_detected = len(self.faces)
         end = time.time()
         print("DNN Face Detection time=", end-start)
         return self.faces
@@ -1066,11 +2894,12 @@ class DnnDetector(BaseDetector):
     def applyDetections(self, frame):
         self.people_detected = 0
 
-        if self.faces == None:
+        if self.faces is None:
             return 0
 
         for (x,y,w,h,confidence) in self.faces:
             self.people_detected += 1
+            (x, y, w, h) = (int(x), int(y), int(w), int(h))
 
             ###########################################
             # Save images to file
@@ -1110,9 +2939,16 @@ class FaceRecognizer():
         self._LBPRecognizer = None
         self._EigenRecognizer = None
         self._FisherRecognizer = None
-        self._LBPRecognizer_file = self.path + GCo.LBP_TRAINING_FILE
-        self._EigenRecognizer_file = self.path + GCo.EIGEN_TRAINING_FILE
-        self._FisherRecognizer_file = self.path + GCo.FISHER_TRAINING_FILE
+        self._LBPCoarseRecognizer = None
+        self._version = 0
+        self._pendingModels = None
+        self._loader = None
+        # OpenCV releases the GIL, every recognizer runs in its own thread
+        self._pool = ThreadPool(processes=3)
+        self._cascadeStats = {"faces": 0, "saved": 0.0}
+        for algorithm in GCo.CASCADE_ORDER:
+            self._cascadeStats[algorithm] = {"evaluated": 0, "accepted": 0, "time": 0.0}
+        self._multiResStats = {"coarse": 0, "fine": 0}
         self.initialize()
 
     def isAudioEnabled(self):
@@ -1121,146 +2957,312 @@ class FaceRecognizer():
     def setAudioEnabled(self, enabled):
         self._audio = enabled
 
-    def initialize(self):
-        if GCo.LBP_ENABLED and os.path.isfile(self._LBPRecognizer_file):
+    def _readModels(self, version):
+        models = {"version": version, "lbp": None, "eigen": None, "fisher": None, "coarse": None}
+        lbp_file = self.path + modelFile(GCo.LBP_TRAINING_FILE, version)
+        eigen_file = self.path + modelFile(GCo.EIGEN_TRAINING_FILE, version)
+        fisher_file = self.path + modelFile(GCo.FISHER_TRAINING_FILE, version)
+        coarse_file = self.path + modelFile(GCo.LBP_COARSE_TRAINING_FILE, version)
+
+        if GCo.LBP_ENABLED and os.path.isfile(lbp_file):
             start = time.time()
             print("LBPHFaceRecognizer read starts")
-            self._LBPRecognizer = cv2.face.LBPHFaceRecognizer_create()
+            models["lbp"] = createLBPHRecognizer()
             try: 
-                self._LBPRecognizer.read(self._LBPRecognizer_file)
+                models["lbp"] = readModel(createLBPHRecognizer, lbp_file, GCo.LBPH_BACKEND)
             except:
                 print("Warning: lbp trainning file empty or already in use")
             print("LBPFaceRecognizer read done")
             end = time.time()
             print("LBP Loading Training file time=", end-start)
 
-        if GCo.EIGEN_ENABLED and os.path.isfile(self._EigenRecognizer_file):
+        if GCo.EIGEN_ENABLED and os.path.isfile(eigen_file):
             start = time.time()
             print("EigenFaceRecognizer read starts")
-            self._EigenRecognizer = cv2.face.EigenFaceRecognizer_create()
+            models["eigen"] = cv2.face.EigenFaceRecognizer_create()
             try: 
-                self._EigenRecognizer.read(self._EigenRecognizer_file)
+                models["eigen"] = readModel(cv2.face.EigenFaceRecognizer_create, eigen_file, GCo.SUBSPACE_BACKEND)
             except:
                 print("Warning: Eigen trainning file empty or already in use")
             print("EigenFaceRecognizer read done")
             end = time.time()
             print("EIGEN Loading Training file time=", end-start)
 
-        if GCo.FISHER_ENABLED and os.path.isfile(self._FisherRecognizer_file):
+        if GCo.FISHER_ENABLED and os.path.isfile(fisher_file):
             start = time.time()
             print("FisherFaceRecognizer")
-            self._FisherRecognizer = cv2.face.FisherFaceRecognizer_create()
+            models["fisher"] = cv2.face.FisherFaceRecognizer_create()
             try: 
-                self._FisherRecognizer.read(self._FisherRecognizer_file)
+                models["fisher"] = readModel(cv2.face.FisherFaceRecognizer_create, fisher_file, GCo.SUBSPACE_BACKEND)
             except:
                 print("Warning: trainning file empty or already in use")
             print("FisherFaceRecognizer read done")
             end = time.time()
             print("FISHER Loading Training file time=", end-start)
 
+        if GCo.LBP_ENABLED and GCo.MULTIRES_ENABLED and os.path.isfile(coarse_file):
+            start = time.time()
+            try:
+                models["coarse"] = readModel(createLBPHRecognizer, coarse_file, GCo.LBPH_BACKEND)
+            except cv2.error:
+                print("Warning: lbp coarse trainning file empty or already in use")
+                models["coarse"] = None
+            end = time.time()
+            print("LBP coarse Loading Training file time=", end-start)
+
+        return models
+
+    def _setModels(self, models):
+        self._version = models["version"]
+        self._LBPRecognizer = models["lbp"]
+        self._EigenRecognizer = models["eigen"]
+        self._FisherRecognizer = models["fisher"]
+        self._LBPCoarseRecognizer = models["coarse"]
+
+    def initialize(self):
+        self._setModels(self._readModels(readModelVersion(self.path)))
 
     def refreshRecognizerData(self):
         self.initialize()
         print("Recognizer refreshed")
 
+    ###########################################
+    # Double buffering: a new model version is read by a loader
+    # thread while recognition keeps using the current models,
+    # swapModels() switches to them from the main loop
+    ###########################################
+    def loadModelsAsync(self, version):
+        def load():
+            self._pendingModels = self._readModels(version)
+        self._loader = threading.Thread(target=load)
+        self._loader.daemon = True
+        self._loader.start()
+
+    def swapModels(self):
+        models = self._pendingModels
+        if models == None:
+            return False
+        self._pendingModels = None
+        self._loader = None
+        self._setModels(models)
+        print("Recognizer models swapped, version=", self._version)
+        return True
+
+    def getModelVersion(self):
+        return self._version
+
+    def enrollFaces(self, faces, ids):
+        # adds the new samples to the loaded LBP model, no need to reload the yml file
+        if not GCo.LBP_ENABLED or len(ids) == 0:
+            return
+
+        start = time.time()
+        if self._LBPRecognizer == None:
+            self._LBPRecognizer = createLBPHRecognizer()
+            self._LBPRecognizer.train(faces, ids)
+        else:
+            self._LBPRecognizer.update(faces, ids)
+
+        if GCo.MULTIRES_ENABLED:
+            size = (GCo.COARSE_GRID_SIZE, GCo.COARSE_GRID_SIZE)
+            coarse = [cv2.resize(face, size, interpolation=cv2.INTER_AREA) for face in faces]
+            if self._LBPCoarseRecognizer == None:
+                self._LBPCoarseRecognizer = createLBPHRecognizer()
+                self._LBPCoarseRecognizer.train(coarse, ids)
+            else:
+                self._LBPCoarseRecognizer.update(coarse, ids)
+        end = time.time()
+        print("LBP Enrollment time=", end-start)
+
     def isRecognizerValid(self):
         return (self._LBPRecognizer != None)
 
     def getNames(self):
         return self.LBPNames, self.EigenNames, self.FisherNames
 
-    def predict(self, frame, gray, x, y, w, h, det_conf):
+    def _normalizeFaces(self, gray, faces):
         ###########################################
-        # Extract face area and resize face it
+        # Extract every face area and resize it once into a
+        # preallocated array shared by all the recognizers,
+        # origins are the positions of the kept faces in faces
         ###########################################
-        try:
-            faceImg = gray[y:y+h,x:x+w]
-            faceImg = cv2.resize(faceImg,(GCo.GRIDX_SIZE, GCo.GRIDY_SIZE))
-        except:
-            print("Unable to process faces, aborting recognition")
-            return
-
+        crops = np.empty((len(faces), GCo.GRIDY_SIZE, GCo.GRIDX_SIZE), dtype=np.uint8)
+        valid = np.zeros(len(faces), dtype=bool)
+        for i in range(len(faces)):
+            (x, y, w, h) = (int(faces["x"][i]), int(faces["y"][i]), int(faces["w"][i]), int(faces["h"][i]))
+            faceImg = gray[max(y, 0):y+h, max(x, 0):x+w]
+            if faceImg.size == 0:
+                print("Unable to process face", (x, y, w, h))
+                continue
+            crops[i] = cv2.resize(faceImg, (GCo.GRIDX_SIZE, GCo.GRIDY_SIZE))
+            valid[i] = True
+        return crops[valid], faces[valid], np.flatnonzero(valid)
+
+    def _topCandidates(self, recognizer, crop, k):
+        if isinstance(recognizer, LBPHEngine):
+            return recognizer.predictTopK(crop, k)
+        collector = cv2.face.StandardCollector_create()
+        recognizer.predict_collect(crop, collector)
+        candidates = []
+        labels = set()
+        for (label, distance) in collector.getResults(sorted=True):
+            if label not in labels:
+                labels.add(label)
+                candidates.append((label, distance))
+                if len(candidates) == k:
+                    break
+        return candidates
+
+    def _predictMultiRes(self, crop):
         ###########################################
-        # Classify face by Local Binary Patterns Algoritm
+        # Screen the face with the coarse model, accept it when the
+        # best person wins by COARSE_MARGIN over any other person,
+        # otherwise ask the full resolution model
         ###########################################
+        size = (GCo.COARSE_GRID_SIZE, GCo.COARSE_GRID_SIZE)
+        candidates = self._topCandidates(self._LBPCoarseRecognizer,
+                                         cv2.resize(crop, size, interpolation=cv2.INTER_AREA), GCo.COARSE_CANDIDATES)
+        if len(candidates) > 0:
+            names = [personName(name) for name in self.db.getNamesForIds([label for (label, distance) in candidates])]
+            margin = GCo.COARSE_MARGIN
+            for n in range(1, len(candidates)):
+                if names[n] != names[0]:
+                    margin = candidates[n][1] - candidates[0][1]
+                    break
+            if margin >= GCo.COARSE_MARGIN:
+                self._multiResStats["coarse"] += 1
+                return candidates[0]
+
+        self._multiResStats["fine"] += 1
+        return self._LBPRecognizer.predict(crop)
+
+    def getMultiResStats(self):
+        return dict(self._multiResStats)
+
+    def _enabledRecognizers(self):
+        recognizers = []
+        if GCo.LBP_ENABLED and self._LBPRecognizer != None:
+            if GCo.MULTIRES_ENABLED and self._LBPCoarseRecognizer != None:
+                recognizers.append((GCo.LBP_RECOGNITION, "LBP", self._predictMultiRes))
+            else:
+                recognizers.append((GCo.LBP_RECOGNITION, "LBP", self._LBPRecognizer.predict))
+        if GCo.EIGEN_ENABLED and self._EigenRecognizer != None:
+            recognizers.append((GCo.EIGEN_RECOGNITION, "EIGEN", self._EigenRecognizer.predict))
+        if GCo.FISHER_ENABLED and self._FisherRecognizer != None:
+            recognizers.append((GCo.FISHER_RECOGNITION, "FISHER", self._FisherRecognizer.predict))
+        return recognizers
+
+    def _predictAll(self, task):
+        (algorithm, title, predict, crops) = task
+        start = time.time()
         try:
-            if GCo.LBP_ENABLED:
-                start = time.time()
-                print("LPB starts")
-                ids,conf = self._LBPRecognizer.predict(faceImg)
-                print("LPB=", ids, conf)
-                end = time.time()
-                print("LBP Predict time=", end-start)
-
-                result = self.db.getNamesFromIds(ids)
-                if result == None:
-                    print("Null result")
-                    return result
-
-                if len(result) == 0:
-                    return "?",conf
-                name = result[0][0]
-                print(result, ids, conf)
+            predictions = [predict(crop) for crop in crops]
+        except cv2.error as e:
+            print(title + " Predict failed:", e)
+            predictions = []
+        end = time.time()
+        print(title + " Predict time=", end-start, "faces=", len(crops))
+        return algorithm, predictions, end-start
 
-                self.LBPNames.append({"name":name, "id":ids, "det_conf":det_conf, "conf": conf, "x":x, "y":y, "h":h})
-        except:
-            print("Exception occurred!")
+    def _people(self, faces, origins, indexes, predictions):
+        names = self.db.getNamesForIds([ids for (ids, conf) in predictions])
+        return [{"name": names[n], "id": predictions[n][0], "det_conf": float(faces["conf"][i]),
+                 "conf": predictions[n][1], "x": int(faces["x"][i]), "y": int(faces["y"][i]),
+                 "h": int(faces["h"][i]), "face": int(origins[i])} for (n, i) in enumerate(indexes[:len(predictions)])]
 
+    def _predictCascade(self, crops, faces, origins):
         ###########################################
-        # Classify face by Eigen Algoritm
+        # Every stage only sees the faces the previous stages
+        # were not confident about, the last stage decides the rest
         ###########################################
-        try:
-            if GCo.EIGEN_ENABLED:
-                start = time.time()
-                print("Eigen starts")
-                ids,conf = self._EigenRecognizer.predict(faceImg)
-                print("Eigen=", ids, conf)
-                end = time.time()
-                print("EIGEN Predict time=", end-start)
-
-                result = self.db.getNamesFromIds(ids)
-                if result == None:
-                    print("Null result")
-                    return result
-
-                if len(result) == 0:
-                    return "?",conf
-                name = result[0][0]
-                print(result, ids, conf)
-
-                self.EigenNames.append({"name":name, "id":ids, "det_conf":det_conf, "conf": conf, "x":x, "y":y, "h":h})
-        except:
-            print("Exception occurred!")
-
+        recognizers = dict([(algorithm, (title, predict)) for (algorithm, title, predict) in self._enabledRecognizers()])
+        stages = [algorithm for algorithm in GCo.CASCADE_ORDER if algorithm in recognizers]
+        pending = list(range(len(faces)))
+        results = {}
+        self._cascadeStats["faces"] += len(faces)
+
+        for stage, algorithm in enumerate(stages):
+            stats = self._cascadeStats[algorithm]
+            if len(pending) == 0:
+                # faces skipped by this stage, valued at its average cost
+                if stats["evaluated"] > 0:
+                    self._cascadeStats["saved"] += len(faces) * stats["time"] / stats["evaluated"]
+                continue
+
+            (title, predict) = recognizers[algorithm]
+            algorithm, predictions, elapsed = self._predictAll((algorithm, title, predict, crops[pending]))
+            stats["evaluated"] += len(predictions)
+            stats["time"] += elapsed
+            skipped = len(faces) - len(pending)
+            if skipped > 0 and len(predictions) > 0:
+                self._cascadeStats["saved"] += skipped * elapsed / len(predictions)
+
+            last = (stage == len(stages) - 1)
+            accepted = [n for n in range(len(predictions)) if last or predictions[n][1] <= GCo.CASCADE_THRESHOLDS[algorithm]]
+            stats["accepted"] += len(accepted)
+            results[algorithm] = self._people(faces, origins, [pending[n] for n in accepted], [predictions[n] for n in accepted])
+            pending = [pending[n] for n in range(len(pending)) if n not in accepted]
+
+        return results
+
+    def getCascadeStats(self):
         ###########################################
-        # Classify face by Fisher algoritm
+        # Per stage hit rate and the predict time saved by not
+        # running every recognizer on every face
         ###########################################
-        try:
-            if GCo.FISHER_ENABLED:
-                start = time.time()
-                print("Fisher starts")
-                ids,conf = self._FisherRecognizer.predict(faceImg)
-                print("Fisher=", ids, conf)
-                end = time.time()
-                print("FISHER Predict time=", end-start)
-
-                result = self.db.getNamesFromIds(ids)
-                if result == None:
-                    print("Null result")
-                    return result
-
-                if len(result) == 0:
-                    return "?",conf
-                name = result[0][0]
-                print(result, ids, conf)
-
-                self.FisherNames.append({"name":name, "id":ids, "det_conf":det_conf, "conf": conf, "x":x, "y":y, "h":h})
-        except:
-            print("Exception occurred!")
+        report = {"faces": self._cascadeStats["faces"], "saved": self._cascadeStats["saved"]}
+        for algorithm in GCo.CASCADE_ORDER:
+            stats = self._cascadeStats[algorithm]
+            hit_rate = 0.0
+            if stats["evaluated"] > 0:
+                hit_rate = stats["accepted"] / float(stats["evaluated"])
+            report[algorithm] = dict(stats, hit_rate=hit_rate)
+        return report
+
+    def predictBatch(self, gray, detections):
+        ###########################################
+        # Returns {algorithm: [person per face]}, a person is
+        # {"name", "id", "det_conf", "conf", "x", "y", "h", "face"}
+        # with name None when the id is not in the db and face
+        # the position of the face in detections.
+        # In cascade mode every face appears only once, under
+        # the algorithm that decided it.
+        ###########################################
+        crops, faces, origins = self._normalizeFaces(gray, toFaces(detections))
+        results = {}
+        if len(faces) == 0:
+            return results
+
+        if GCo.RECOGNITION_CASCADE:
+            results = self._predictCascade(crops, faces, origins)
+            print("Recognition cascade:", self.getCascadeStats())
+            return results
+
+        tasks = [(algorithm, title, predict, crops) for (algorithm, title, predict) in self._enabledRecognizers()]
+        for algorithm, predictions, elapsed in self._pool.map(self._predictAll, tasks):
+            results[algorithm] = self._people(faces, origins, list(range(len(faces))), predictions)
+        return results
+
+    def _recognizeFaces(self, gray, detections):
+        results = self.predictBatch(gray, detections)
+        self.LBPNames = self._knownPeople(results, GCo.LBP_RECOGNITION)
+        self.EigenNames = self._knownPeople(results, GCo.EIGEN_RECOGNITION)
+        self.FisherNames = self._knownPeople(results, GCo.FISHER_RECOGNITION)
+        return self.LBPNames, self.EigenNames, self.FisherNames
+
+    def _knownPeople(self, results, algorithm):
+        return [person for person in results.get(algorithm, []) if person["name"] != None]
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
 
     def haarCascadeApplyRecognitions(self, frame, lpb_names, eigen_names, fisher_names):
         color = (0, 255, 0)
 
+        # in cascade mode every face is reported by only one algorithm
+        cascade_audio = self._audio and GCo.RECOGNITION_CASCADE
+
         if GCo.LBP_ENABLED:
             for person in self.LBPNames:
                  self.im.markFace(frame, self._audio,person["name"], person["id"], person["det_conf"],
@@ -1268,17 +3270,20 @@ class FaceRecognizer():
 
         if GCo.EIGEN_ENABLED:
             for person in self.EigenNames:
-                 self.im.markFace(frame, False, person["name"], person["id"], person["det_conf"], 
+                 self.im.markFace(frame, cascade_audio, person["name"], person["id"], person["det_conf"], 
                                   person["conf"], person["x"], person["y"], person["h"], color, GCo.EIGEN_RECOGNITION)
 
         if GCo.FISHER_ENABLED:
             for person in self.FisherNames:
-                self.im.markFace(frame, False, person["name"], person["id"], person["det_conf"],
+                self.im.markFace(frame, cascade_audio, person["name"], person["id"], person["det_conf"],
                 person["conf"], person["x"], person["y"], person["h"], color, GCo.FISHER_RECOGNITION)
 
     def dnnApplyRecognitions(self, frame, lpb_names, eigen_names, fisher_names):
         color = (0, 255, 255)
 
+        # in cascade mode every face is reported by only one algorithm
+        cascade_audio = self._audio and GCo.RECOGNITION_CASCADE
+
         if GCo.LBP_ENABLED:
             for person in self.LBPNames:
                 self.im.markFace(frame, self._audio,person["name"], person["id"], person["det_conf"],
@@ -1286,42 +3291,477 @@ class FaceRecognizer():
 
         if GCo.EIGEN_ENABLED:
             for person in self.EigenNames:
-                self.im.markFace(frame, False, person["name"], person["id"], person["det_conf"],
+                self.im.markFace(frame, cascade_audio, person["name"], person["id"], person["det_conf"],
                                  person["conf"], person["x"], person["y"], person["h"], color, GCo.EIGEN_RECOGNITION)
 
         if GCo.FISHER_ENABLED:
             for person in self.FisherNames:
-                self.im.markFace(frame, False, person["name"], person["id"], person["det_conf"],
+                self.im.markFace(frame, cascade_audio, person["name"], person["id"], person["det_conf"],
                                  person["conf"], person["x"], person["y"], person["h"], color, GCo.FISHER_RECOGNITION)
 
-    def haarCascadeFaceRecognition(self, frame, detections, gray):
-        self.LBPNames = []
-        self.EigenNames = []
-        self.FisherNames = []
-
-        if detections == None:
-            return self.LBPNames, self.EigenNames, self.FisherNames
-
-        for (x,y,w,h) in detections:
-            self.predict(frame, gray, x, y, w, h, 100)
+    def tracksApplyRecognitions(self, frame, tracks):
+        color = (255, 255, 0)
+
+        # the cached people are drawn where the track is now,
+        # a track is announced once when its identity changes
+        for track in tracks:
+            (x, y, w, h) = track["box"]
+            cv2.rectangle(frame, (x, y), (x+w, y+h), color, 2)
+            cv2.putText(frame, "#" + str(track["id"]), (x, y-5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+            audio = self._audio and track["announce"]
+            track["announce"] = False
+            for algorithm in GCo.CASCADE_ORDER:
+                person = track["people"].get(algorithm)
+                if person != None and person["name"] != None:
+                    self.im.markFace(frame, audio, person["name"], person["id"], track["det_conf"],
+                                     person["conf"], x, y, h, color, algorithm)
+                    audio = False
 
-        return self.LBPNames, self.EigenNames, self.FisherNames
+    def haarCascadeFaceRecognition(self, frame, detections, gray):
+        return self._recognizeFaces(gray, toFaces(detections, 100))
 
     def lbpFaceRecognition(self, frame, detections, gray):
         return self.haarCascadeFaceRecognition(frame, detections, gray)
 
     def dnnFaceRecognition(self, frame, detections, gray):
-        self.LBPNames = []
-        self.EigenNames = []
-        self.FisherNames = []
+        return self._recognizeFaces(gray, detections)
 
-        if detections == None:
-            return self.LBPNames, self.EigenNames, self.FisherNames
+def createTracker(kind):
+    # the tracker factories moved to cv2.legacy in opencv 4.5
+    for module in [getattr(cv2, "legacy", None), cv2]:
+        create = getattr(module, "Tracker" + kind + "_create", None)
+        if kind != "" and create != None:
+            return create()
+    return None
 
-        for (x,y,w,h,confidence) in detections:
-            self.predict(frame, gray, x, y, w, h, confidence)
+class FaceTracker():
+    ###########################################################################
+    # A track per face: detections are associated to the tracks by IoU (and
+    # by centroid distance when the box moved too much), between detections
+    # an OpenCV tracker follows every face. Each track caches the people the
+    # recognizers returned for it, {algorithm: person}.
+    ###########################################################################
+    def __init__(self):
+        self._tracks = []
+        self._nextId = 1
+        self._stats = {"detections": 0, "followed": 0, "recognized": 0, "cached": 0}
+        self._detectInterval = GCo.TRACK_DETECT_INTERVAL
+        self.reset()
+
+    def reset(self):
+        self._tracks = []
+        self._framesSinceDetection = self._detectInterval
+        self._lost = False
+
+    def setDetectInterval(self, frames):
+        self._detectInterval = frames
+
+    def getTracks(self):
+        return self._tracks
+
+    def getStats(self):
+        return dict(self._stats)
+
+    def needsDetection(self):
+        return self._lost or self._framesSinceDetection >= self._detectInterval
+
+    def _overlaps(self, faces):
+        boxes = np.array([track["box"] for track in self._tracks], dtype=np.float32).reshape(-1, 4)
+        x1 = np.maximum(boxes[:, 0:1], faces["x"])
+        y1 = np.maximum(boxes[:, 1:2], faces["y"])
+        x2 = np.minimum(boxes[:, 0:1] + boxes[:, 2:3], faces["x"] + faces["w"])
+        y2 = np.minimum(boxes[:, 1:2] + boxes[:, 3:4], faces["y"] + faces["h"])
+        inter = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        union = boxes[:, 2:3] * boxes[:, 3:4] + faces["w"] * faces["h"] - inter
+        overlaps = inter / np.maximum(union, 1)
+
+        # centroid distance relative to the track height
+        dx = (boxes[:, 0:1] + boxes[:, 2:3] / 2) - (faces["x"] + faces["w"] / 2.0)
+        dy = (boxes[:, 1:2] + boxes[:, 3:4] / 2) - (faces["y"] + faces["h"] / 2.0)
+        distances = np.sqrt(dx * dx + dy * dy) / np.maximum(boxes[:, 3:4], 1)
+        return overlaps, distances
+
+    def _associate(self, faces):
+        ###########################################
+        # Greedy matching, best IoU first, the faces left
+        # go to the nearest track within TRACK_CENTROID_DISTANCE
+        ###########################################
+        matches = {}
+        if len(self._tracks) == 0 or len(faces) == 0:
+            return matches
+        overlaps, distances = self._overlaps(faces)
+        for (scores, accept) in [(-overlaps, -GCo.TRACK_IOU_THRESHOLD), (distances, GCo.TRACK_CENTROID_DISTANCE)]:
+            for flat in np.argsort(scores, axis=None):
+                (t, f) = np.unravel_index(flat, scores.shape)
+                if scores[t, f] > accept:
+                    break
+                if t not in matches and f not in matches.values():
+                    matches[int(t)] = int(f)
+        return matches
+
+    def _startTracker(self, track, frame, box):
+        track["box"] = tuple([int(v) for v in box])
+        track["tracker"] = createTracker(GCo.TRACKER_TYPE)
+        if track["tracker"] != None:
+            track["tracker"].init(frame, track["box"])
+
+    def update(self, frame, detections):
+        faces = toFaces(detections)
+        matches = self._associate(faces)
+        self._framesSinceDetection = 0
+        self._lost = False
+        self._stats["detections"] += 1
+
+        tracks = []
+        for t, track in enumerate(self._tracks):
+            if t in matches:
+                f = matches[t]
+                self._startTracker(track, frame, (faces["x"][f], faces["y"][f], faces["w"][f], faces["h"][f]))
+                track["det_conf"] = float(faces["conf"][f])
+                track["misses"] = 0
+                track["refreshed"] = True
+            else:
+                track["misses"] += 1
+                if track["misses"] > GCo.TRACK_MAX_MISSES:
+                    continue
+            tracks.append(track)
+
+        for f in range(len(faces)):
+            if f not in matches.values():
+                track = {"id": self._nextId, "det_conf": float(faces["conf"][f]), "misses": 0,
+                         "people": {}, "recognized": 0, "refreshed": True, "announce": False}
+                self._startTracker(track, frame, (faces["x"][f], faces["y"][f], faces["w"][f], faces["h"][f]))
+                self._nextId += 1
+                tracks.append(track)
+        self._tracks = tracks
+
+    def follow(self, frame):
+        self._framesSinceDetection += 1
+        self._stats["followed"] += 1
+        for track in self._tracks:
+            if track["tracker"] == None:
+                continue
+            ok, box = track["tracker"].update(frame)
+            if ok:
+                track["box"] = tuple([int(v) for v in box])
+            else:
+                # the next frame runs a full detection
+                self._lost = True
+
+    def _isUncertain(self, track):
+        if len(track["people"]) == 0:
+            return True
+        for algorithm, person in track["people"].items():
+            if person["name"] == None or person["conf"] > GCo.CASCADE_THRESHOLDS[algorithm]:
+                return True
+        return False
+
+    def pendingRecognition(self):
+        ###########################################
+        # New tracks, uncertain tracks with a fresh detection
+        # and confident tracks not checked for a while
+        ###########################################
+        now = time.time()
+        pending = []
+        for index, track in enumerate(self._tracks):
+            if track["recognized"] == 0:
+                pending.append(index)
+            elif self._isUncertain(track):
+                if track["refreshed"]:
+                    pending.append(index)
+            elif now - track["recognized"] >= GCo.TRACK_RECOGNIZE_INTERVAL:
+                pending.append(index)
+            track["refreshed"] = False
+        self._stats["recognized"] += len(pending)
+        self._stats["cached"] += len(self._tracks) - len(pending)
+        return pending
+
+    def getFaces(self, indexes):
+        faces = np.empty(len(indexes), dtype=GCo.FACE_DTYPE)
+        for n, index in enumerate(indexes):
+            track = self._tracks[index]
+            (faces["x"][n], faces["y"][n], faces["w"][n], faces["h"][n]) = track["box"]
+            faces["conf"][n] = track["det_conf"]
+        return faces
+
+    def assignPeople(self, indexes, results):
+        # results of predictBatch(getFaces(indexes)), the face of a person
+        # is its position in indexes
+        names = dict([(index, self._trackName(self._tracks[index])) for index in indexes])
+        now = time.time()
+        for index in indexes:
+            self._tracks[index]["people"] = {}
+            self._tracks[index]["recognized"] = now
+        for algorithm, people in results.items():
+            for person in people:
+                self._tracks[indexes[person["face"]]]["people"][algorithm] = person
+        for index in indexes:
+            # announce only when the track identity changes
+            name = self._trackName(self._tracks[index])
+            if name != None and name != names[index]:
+                self._tracks[index]["announce"] = True
+
+    def _trackName(self, track):
+        for algorithm in GCo.CASCADE_ORDER:
+            person = track["people"].get(algorithm)
+            if person != None and person["name"] != None:
+                return person["name"]
+        return None
+
+class MotionDetector():
+    ###########################################################################
+    # Frame differencing against a running average background, computed on a
+    # MOTION_WIDTH pixels wide blurred gray copy of the frame. The detectors
+    # are triggered when enough of the scene changed, never more often than
+    # MOTION_MIN_INTERVAL and at least every MOTION_MAX_INTERVAL seconds.
+    ###########################################################################
+    def __init__(self):
+        self._background = None
+        self._lastTrigger = 0
+        self._lastTimestamp = 0
+        self._changed = 0.0
+        self._pending = False
+        self._minInterval = GCo.MOTION_MIN_INTERVAL
+        self._stats = {"frames": 0, "motion": 0, "timeout": 0, "manual": 0, "throttled": 0, "time": 0.0}
 
-        return self.LBPNames, self.EigenNames, self.FisherNames
+    def getChanged(self):
+        return self._changed
+
+    def setMinInterval(self, seconds):
+        self._minInterval = seconds
+
+    def getStats(self):
+        return dict(self._stats)
+
+    def _measure(self, frame):
+        start = time.time()
+        height = max(1, frame.shape[0] * GCo.MOTION_WIDTH // frame.shape[1])
+        small = cv2.resize(frame, (GCo.MOTION_WIDTH, height), interpolation=cv2.INTER_AREA)
+        if len(small.shape) == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+
+        if self._background is None or self._background.shape != small.shape:
+            # a new background has nothing to compare against, not a motion
+            self._background = small.astype(np.float32)
+            changed = 0.0
+        else:
+            diff = cv2.absdiff(small, cv2.convertScaleAbs(self._background))
+            changed = np.count_nonzero(diff > GCo.MOTION_PIXEL_THRESHOLD) / float(diff.size)
+            cv2.accumulateWeighted(small, self._background, GCo.MOTION_LEARNING_RATE)
+
+        self._stats["frames"] += 1
+        self._stats["time"] += time.time() - start
+        return changed
+
+    def shouldTrigger(self, frame, timestamp, manual=False):
+        now = time.time()
+        if frame is not None and timestamp != self._lastTimestamp:
+            self._lastTimestamp = timestamp
+            self._changed = self._measure(frame)
+            if self._changed >= GCo.MOTION_AREA:
+                # motion seen too early still triggers once the interval is over,
+                # throttled counts the motion frames, not the loop iterations
+                self._pending = True
+                if now - self._lastTrigger < self._minInterval:
+                    self._stats["throttled"] += 1
+
+        reason = None
+        if manual:
+            reason = "manual"
+        elif now - self._lastTrigger >= GCo.MOTION_MAX_INTERVAL:
+            reason = "timeout"
+        elif self._pending:
+            if now - self._lastTrigger < self._minInterval:
+                return False
+            reason = "motion"
+        if reason == None:
+            return False
+
+        self._stats[reason] += 1
+        self._lastTrigger = now
+        self._pending = False
+        return True
+
+class LatencyScheduler():
+    ###########################################################################
+    # Moving averages of the wall time of every stage of the loop (capture,
+    # detect per detector and resolution, recognize, announce), the cadence
+    # is derived from them: the first SCHEDULER_MODES detector and resolution
+    # that announces a face within SCHEDULER_TARGET_LATENCY, the interval
+    # between detections and the loop delay that keep the vision work within
+    # SCHEDULER_CPU_BUDGET. Detectors not measured yet use their prior cost.
+    ###########################################################################
+    def __init__(self):
+        self._costs = {}
+        self._counts = {}
+        self._announced = (0, 0.0)
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        start = time.time()
+        yield
+        self.record(stage, time.time() - start)
+
+    def record(self, stage, seconds):
+        if stage in self._costs:
+            self._costs[stage] += GCo.SCHEDULER_SMOOTHING * (seconds - self._costs[stage])
+        else:
+            self._costs[stage] = seconds
+        self._counts[stage] = self._counts.get(stage, 0) + 1
+
+    def recordAnnouncements(self, stats):
+        # the audio engine counts the announcements and adds up their queue wait
+        (announced, waited) = self._announced
+        if stats["announced"] > announced:
+            self.record("announce", (stats["waited"] - waited) / (stats["announced"] - announced))
+        self._announced = (stats["announced"], stats["waited"])
+
+    def getCost(self, stage):
+        return self._costs.get(stage, 0.0)
+
+    def getStats(self):
+        return dict([(stage, (round(cost, 3), self._counts[stage])) for (stage, cost) in self._costs.items()])
+
+    def detectStage(self, method, scale):
+        return "detect:%d:%.2f" % (method, scale)
+
+    def detectCost(self, method, scale):
+        ###########################################
+        # Measured cost, else scaled from the same detector
+        # at another resolution (cost ~ pixels), else the prior
+        ###########################################
+        stage = self.detectStage(method, scale)
+        if stage in self._costs:
+            return self._costs[stage]
+        for (other_method, other_scale) in GCo.SCHEDULER_MODES:
+            measured = self._costs.get(self.detectStage(method, other_scale))
+            if other_method == method and measured != None:
+                return measured * (scale / other_scale) ** 2
+        return GCo.SCHEDULER_PRIOR_COSTS[method] * scale ** 2
+
+    def pipelineLatency(self, method, scale):
+        return self.getCost("capture") + self.detectCost(method, scale) + self.getCost("recognize") +\
+               self.getCost("announce")
+
+    def chooseDetection(self, methods):
+        # first mode within the target latency, the fastest one when none is
+        best = (None, 1.0, 0)
+        for (method, scale) in GCo.SCHEDULER_MODES:
+            if method not in methods:
+                continue
+            latency = self.pipelineLatency(method, scale)
+            if latency <= GCo.SCHEDULER_TARGET_LATENCY:
+                return method, scale
+            if best[0] == None or latency < best[2]:
+                best = (method, scale, latency)
+        return best[0], best[1]
+
+    def getDetectionInterval(self, method, scale):
+        ###########################################
+        # The longest interval that still announces a new face
+        # within the target, never shorter than the cpu budget allows
+        ###########################################
+        work = self.detectCost(method, scale) + self.getCost("recognize")
+        interval = max(GCo.SCHEDULER_TARGET_LATENCY - self.pipelineLatency(method, scale),
+                       work / GCo.SCHEDULER_CPU_BUDGET)
+        return min(interval, GCo.SCHEDULER_MAX_INTERVAL)
+
+    def getSkipFrames(self, method, scale):
+        # loops counted by the trigger counter
+        return max(1, int(self.getDetectionInterval(method, scale) / max(self.getCost("loop"), 0.001)))
+
+    def getTrackingInterval(self, method, scale):
+        ###########################################
+        # Frames between full detections in continuous mode, the
+        # detection is spread over the frames the tracker follows
+        ###########################################
+        period = max(self.getCost("loop"), 0.001)
+        spare = GCo.SCHEDULER_CPU_BUDGET * period - self.getCost("follow")
+        frames = GCo.SCHEDULER_MAX_INTERVAL / period
+        if spare > 0:
+            frames = min(frames, self.detectCost(method, scale) / spare)
+        frames = max(frames, (GCo.SCHEDULER_TARGET_LATENCY - self.pipelineLatency(method, scale)) / period)
+        return max(1, int(min(frames, GCo.SCHEDULER_MAX_INTERVAL / period)))
+
+    def getLoopDelay(self, continuous):
+        # milliseconds waited for a key, in continuous mode enough to keep the cpu budget
+        if not continuous:
+            return GCo.DISPLAY_WAIT
+        return max(1, int(1000 * self.getCost("work") * (1.0 / GCo.SCHEDULER_CPU_BUDGET - 1)))
+
+@singleton
+class BootTimeline():
+    ###########################################################################
+    # Load times of the components, measured since the module was loaded.
+    # start() loads a component in the boot thread pool, report() prints
+    # the timeline once the device is ready.
+    ###########################################################################
+    def __init__(self):
+        self._boot = time.time()
+        self._events = []
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def measure(self, name, function, *args):
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            end = time.time()
+            with self._lock:
+                self._events.append((name, start - self._boot, end - self._boot, threading.current_thread().name))
+
+    def start(self, name, function, *args):
+        with self._lock:
+            if self._pool == None:
+                self._pool = ThreadPool(processes=GCo.BOOT_THREADS)
+        return self._pool.apply_async(self.measure, (name, function) + args)
+
+    def mark(self, name):
+        now = time.time() - self._boot
+        with self._lock:
+            self._events.append((name, now, now, threading.current_thread().name))
+
+    def report(self):
+        print("Boot timeline (seconds since start):")
+        with self._lock:
+            events = sorted(self._events, key=lambda event: event[1])
+        for (name, start, end, thread) in events:
+            print("  %-28s %7.3f -> %7.3f %7.3fs  %s" % (name, start, end, end - start, thread))
+
+    def close(self):
+        if self._pool != None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+class LazyComponent():
+    ###########################################################################
+    # Stands for a component loaded in background the first time it is
+    # needed (prefetch), any attribute access waits until it is loaded
+    ###########################################################################
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._result = None
+        self._component = None
+
+    def prefetch(self):
+        if self._result == None:
+            self._result = BootTimeline().start(self._name, self._factory)
+        return self
+
+    def isLoaded(self):
+        return self._component != None or (self._result != None and self._result.ready())
+
+    def get(self):
+        if self._component == None:
+            self._component = self.prefetch()._result.get()
+        return self._component
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
 
 class MainController():
     def __init__(self, trainer):
@@ -1332,6 +3772,7 @@ class MainController():
         self._camera = Camera()
         self._audioctl = AudioController()
         self._frame = None
+        self._frameTime = 0
         self._gray = None
         self._ret = 0
         self._dnnRegFaces = None
@@ -1341,9 +3782,15 @@ class MainController():
         self._hcFaces = None
         self._lbpFaces = None
         self._triggerCounter = GCo.SKIP_FRAMES
+        self._skipFrames = GCo.SKIP_FRAMES
+        self._detectionScale = 1.0
+        self._waitTime = GCo.DISPLAY_WAIT
+        self._scheduler = LatencyScheduler()
+        self._motion = MotionDetector()
         self._lbp_people_detected = 0
         self._hc_people_detected = 0
         self._dnn_people_detected = 0
+        self._trainingAnnounced = 0
         self.loadingError = False
         self.initialize()
 
@@ -1353,40 +3800,118 @@ class MainController():
         self._nm.setForceDisplayEnabled(True)
         self._registration = Registration()
 
-        print("instancing hr detector")
-        self._hcDet = HaarCascadeDetector()
-        if self._hcDet.isDetectorValid() == False:
-            self.loadingError = True
-            print("Error loading HaarCascade Detector")
-
-        print("instancing lbp detector")
-        self._lbpDet = LBPDetector()
-        if self._lbpDet.isDetectorValid() == False:
-            self.loadingError = True
-            print("Error loading LBP Detector")
-
-        print("instancing dnn detector")
-        self._dnnDet = DnnDetector()
-        if self._hcDet.isDetectorValid() == False:
-            self.loadingError = True
-            print("Error loading Dnn Detector")
+        ###########################################
+        # The recognizer and the detector of the selected method
+        # load concurrently, the other detectors are loaded in
+        # background when their method is selected
+        ###########################################
+        timeline = BootTimeline()
+        self._hcDet = LazyComponent("haar cascade detector", self._detectorFactory(HaarCascadeDetector, "HaarCascade"))
+        self._lbpDet = LazyComponent("lbp detector", self._detectorFactory(LBPDetector, "LBP"))
+        self._dnnDet = LazyComponent("dnn detector", self._detectorFactory(DnnDetector, "Dnn"))
+        self._detectors = {GCo.HAAR_CASCADE: self._hcDet, GCo.LBP: self._lbpDet, GCo.DNN: self._dnnDet}
 
         print("instancing hr recognizer")
-        self._faceRec = FaceRecognizer()
+        recognizer = timeline.start("face recognizer", FaceRecognizer)
+        self._detectors[self._nm.getDetectionMethod()].prefetch()
+
+        self._faceRec = recognizer.get()
         if self._faceRec.isRecognizerValid() == False:
             self.loadingError = True
             print("Error loading Face Recognizer")
+        self._detectors[self._nm.getDetectionMethod()].get()
+        if GCo.SCHEDULER_ENABLED:
+            # the scheduler chooses among the loaded detectors
+            for detector in self._detectors.values():
+                detector.prefetch()
+
+        self._trainingWorker = TrainingWorker(self._onTrainingProgress, self._onTrainingDone)
+        self._tracker = FaceTracker()
+
+    def _detectorFactory(self, detector_class, title):
+        def create():
+            print("instancing " + title + " detector")
+            detector = detector_class()
+            if detector.isDetectorValid() == False:
+                self.loadingError = True
+                print("Error loading " + title + " Detector")
+            return detector
+        return create
+
+    def _onTrainingProgress(self, progress, eta):
+        if time.time() - self._trainingAnnounced >= GCo.TRAINING_ANNOUNCE_INTERVAL:
+            self._trainingAnnounced = time.time()
+            self._audioctl.cmdTrainingProgress(progress, eta)
+
+    def _onTrainingDone(self, version):
+        self._faceRec.loadModelsAsync(version)
+
+    def _pollTraining(self):
+        self._trainingWorker.poll()
+        if self._faceRec.swapModels():
+            # enrollments write into the version in use, only now the new one
+            writeModelVersion(self._path, self._faceRec.getModelVersion())
+            removeModelVersions(self._path, self._faceRec.getModelVersion())
+            # the cached and announced identities come from the previous models
+            self._tracker.reset()
+            self._audioctl.clearAnnouncements()
+            self._audioctl.cmdTrainingDone()
+
+    def _schedule(self):
+        ###########################################
+        # Apply the cadence derived from the measured
+        # stage costs to the detection and the loop
+        ###########################################
+        self._scheduler.recordAnnouncements(self._audioctl.getStats())
+        if not GCo.SCHEDULER_ENABLED or self._nm.isRegistrationMode():
+            return
+
+        methods = [method for (method, detector) in self._detectors.items()
+                   if detector.isLoaded() and detector.isDetectorValid()]
+        method, scale = self._scheduler.chooseDetection(methods)
+        if method == None:
+            return
+        if method != self._nm.getDetectionMethod() or scale != self._detectionScale:
+            print("Scheduler: detection method", method, "scale", scale, self._scheduler.getStats())
+            self._nm.setDetectionMethod(method)
+            self._detectionScale = scale
+
+        self._skipFrames = self._scheduler.getSkipFrames(method, scale)
+        self._motion.setMinInterval(self._scheduler.getDetectionInterval(method, scale))
+        self._tracker.setDetectInterval(self._scheduler.getTrackingInterval(method, scale))
+        self._waitTime = self._scheduler.getLoopDelay(self.isTracking())
+
+    def close(self):
+        self._trainingWorker.close()
+        self._faceRec.close()
+
+    def isTracking(self):
+        return GCo.TRACKING_ENABLED and self._nm.isDetectionEnabled() and not self._nm.isRegistrationMode()
 
-    def takePicture(self, skipframes):
-        if self._triggerCounter+1 >= GCo.SKIP_FRAMES and (self._nm.isDetectionEnabled() or self._nm.isRecognitionEnabled()):
+    def takePicture(self, since):
+        if self.isTracking() and not self._camera.isEnabled():
+            print("Forcing camera enabled")
+            self._camera.setEnabled(True);
+        elif not GCo.MOTION_TRIGGER_ENABLED and self._triggerCounter+1 >= self._skipFrames and\
+             (self._nm.isDetectionEnabled() or self._nm.isRecognitionEnabled()):
             print("Forcing camera enabled")
             self._camera.setEnabled(True);
 
-        if self._camera.isEnabled() or self._frame == None:
-            for i in range(0,skipframes):
-                ret, self._frame = self._camera.read()
+        if self._camera.isEnabled() or self._frame is None:
+            with self._scheduler.measure("capture"):
+                ret, frame, timestamp = self._camera.readNewerThan(since)
+            if ret:
+                self._frame = frame
+                self._frameTime = timestamp
             return ret, self._frame
 
+        if GCo.MOTION_TRIGGER_ENABLED and self._nm.isDetectionEnabled():
+            # idle frames, never waits so the menu keeps responding
+            ret, frame, timestamp = self._camera.readLatest()
+            if ret and timestamp > self._frameTime:
+                self._frame = frame
+                self._frameTime = timestamp
+
         return 1,self._frame
 
     def displayImage(self):
@@ -1402,7 +3927,11 @@ class MainController():
             ###########################################
             # Add header Information
             ###########################################
-            text = "capture on " + str(GCo.SKIP_FRAMES - self._triggerCounter)
+            text = "capture on " + str(self._skipFrames - self._triggerCounter)
+            if GCo.MOTION_TRIGGER_ENABLED:
+                text = "motion " + "{:d}%".format(int(self._motion.getChanged() * 100))
+            if self.isTracking():
+                text = "tracks " + str(len(self._tracker.getTracks()))
             self._im.setHeader(self._frame, text, (10, 20))
 
             mode = "DETECTION"
@@ -1429,7 +3958,7 @@ class MainController():
             if self._triggerCounter == 0 and (self._nm.isDetectionEnabled() or self._nm.isRecognitionEnabled()):
                 self._im.writeImage(self._frame, path=self._path + "detections/", play_sound=False)
 
-        return self._nm.processKey(self._frame, 50, 0)
+        return self._nm.processKey(self._frame, self._waitTime, 0)
 
     def captureFace(self):
         self._gray = cv2.cvtColor(self._frame, cv2.COLOR_BGR2GRAY)
@@ -1438,23 +3967,24 @@ class MainController():
         print (username)
         face_detected = False
 
+        # registration searches every face size, the user is close to the camera
         if self._lbpDet.getRegistrationsNumber() < GCo.MAX_REG_PICTURES:
             print("lbp next registration")
-            self._lbpRegFaces = self._lbpDet.faceDetection(self._frame, self._gray)
+            self._lbpRegFaces = self._lbpDet.faceDetection(self._frame, self._gray, planned=False)
             lbpExtractedFaces = []
             if len(self._lbpRegFaces) > 0:
                 face_detected = True
-                self._audioctl.cmdSound(GCo.AU_FACEDETECTEDLBP, wait=True)
+                self._audioctl.cmdAnnounce(GCo.AU_FACEDETECTEDLBP)
                 id = self._registration.getNextCounter()
                 lbpExtractedFaces = self._lbpDet.registerDetections(self._frame, self._gray, username, id)
 
         if self._hcDet.getRegistrationsNumber() < GCo.MAX_REG_PICTURES:
             print("hc next registration")
-            self._hcRegFaces = self._hcDet.faceDetection(self._frame, self._gray)
+            self._hcRegFaces = self._hcDet.faceDetection(self._frame, self._gray, planned=False)
             hcExtractedFaces = []
             if len(self._hcRegFaces) > 0:
                 face_detected = True
-                self._audioctl.cmdSound(GCo.AU_FACEDETECTEDHC, wait=True)
+                self._audioctl.cmdAnnounce(GCo.AU_FACEDETECTEDHC)
                 id = self._registration.getNextCounter()
                 hcExtractedFaces = self._hcDet.registerDetections(self._frame, self._gray, username, id)
 
@@ -1464,12 +3994,12 @@ class MainController():
             dnnExtractedFaces = []
             if len(self._dnnRegFaces) > 0:
                 face_detected = True
-                self._audioctl.cmdSound(GCo.AU_FACEDETECTEDDNN, wait=True)
+                self._audioctl.cmdAnnounce(GCo.AU_FACEDETECTEDDNN)
                 id = self._registration.getNextCounter()
                 dnnExtractedFaces = self._dnnDet.registerDetections(self._frame, self._gray, username, id)
 
         if face_detected == False:
-            self._audioctl.cmdSound(GCo.AU_NOFACES, wait=True)
+            self._audioctl.cmdAnnounce(GCo.AU_NOFACES)
 
         if self._lbpDet.getRegistrationsNumber() >= GCo.MAX_REG_PICTURES and\
            self._hcDet.getRegistrationsNumber() >= GCo.MAX_REG_PICTURES and\
@@ -1478,9 +4008,13 @@ class MainController():
             self._registration.stopRegistration()
             self._nm.setRegistrationMode(False)
             self._camera.setEnabled(False)
-            self._trainer.addUserToDB(username, id)
-            self._trainer.trainAll()
-            self._faceRec.refreshRecognizerData()
+            ids, faces = self._trainer.enrollUser(username)
+            self._faceRec.enrollFaces(faces, ids)
+            # whoever was announced under another name can be recognized now
+            self._audioctl.clearAnnouncements()
+            if GCo.BACKGROUND_TRAINING and len(ids) > 0:
+                self._trainingAnnounced = 0
+                self._trainingWorker.start()
 
 #        time.sleep(0.01)
 
@@ -1500,14 +4034,21 @@ class MainController():
                return 1
         return 0
 
+    def _isTriggered(self):
+        manual = self._nm.isTriggerFlagEnabled()
+        self._nm.setTriggerFlagEnabled(False)
+        if GCo.MOTION_TRIGGER_ENABLED:
+            if self._motion.shouldTrigger(self._frame, self._frameTime, manual):
+                print("Motion trigger:", self._motion.getStats())
+                return True
+            return False
+        return manual or self._triggerCounter >= self._skipFrames
+
     def executeDetection(self):
         self._triggerCounter += 1
         lfaces = 0
-        if self._nm.isTriggerFlagEnabled():
-            self._triggerCounter = GCo.SKIP_FRAMES
-            self._nm.setTriggerFlagEnabled(False)
 
-        if self._triggerCounter >= GCo.SKIP_FRAMES:
+        if self._isTriggered():
             self._triggerCounter = 0
                 
             self._gray = cv2.cvtColor(self._frame, cv2.COLOR_BGR2GRAY)
@@ -1521,23 +4062,24 @@ class MainController():
             self._hc_people_detected = 0
             self._dnn_people_detected = 0
 
-            if self._nm.getDetectionMethod() == GCo.HAAR_CASCADE:
-                self._hcFaces = self._hcDet.faceDetection(self._frame, self._gray)
-                people_detected = len(self._hcFaces)
-                self._hc_people_detected = people_detected
-            elif self._nm.getDetectionMethod() == GCo.DNN:
-                self._dnnFaces = self._dnnDet.faceDetection(self._frame, self._gray)
-                people_detected = len(self._dnnFaces)
-                self._dnn_people_detected = people_detected
-            else: # LBP
-                self._lbpFaces = self._lbpDet.faceDetection(self._frame, self._gray)
-                people_detected = len(self._lbpFaces)
-                self._lbp_people_detected = people_detected
+            method = self._nm.getDetectionMethod()
+            with self._scheduler.measure(self._scheduler.detectStage(method, self._detectionScale)):
+                if method == GCo.HAAR_CASCADE:
+                    self._hcFaces = self._hcDet.faceDetection(self._frame, self._gray, self._detectionScale)
+                    people_detected = len(self._hcFaces)
+                    self._hc_people_detected = people_detected
+                elif method == GCo.DNN:
+                    self._dnnFaces = self._dnnDet.faceDetection(self._frame, self._gray, self._detectionScale)
+                    people_detected = len(self._dnnFaces)
+                    self._dnn_people_detected = people_detected
+                else: # LBP
+                    self._lbpFaces = self._lbpDet.faceDetection(self._frame, self._gray, self._detectionScale)
+                    people_detected = len(self._lbpFaces)
+                    self._lbp_people_detected = people_detected
 
             self._camera.setEnabled(False)
             self._nm.setForceDisplayEnabled(True)
-            self._audioctl.cmdSound(GCo.AU_DETECTIONDONE, wait=True)
-            self._audioctl.cmdPeopleDetected(people_detected, wait=True)
+            self._audioctl.cmdDetectionDone(people_detected)
             print("Face Detection done. " + str(people_detected) + " people detected")
             return people_detected
 
@@ -1545,6 +4087,7 @@ class MainController():
 
     def executeRecognition(self):
 	print("Face Recognition started...")
+	start = time.time()
 	if self._nm.getDetectionMethod() == GCo.HAAR_CASCADE:
             self._faceRec.setAudioEnabled(True)
 	    self._faceRec.haarCascadeFaceRecognition(self._frame, self._hcFaces, self._gray)
@@ -1554,17 +4097,59 @@ class MainController():
 	else: #LBP
             self._faceRec.setAudioEnabled(True)
 	    self._faceRec.lbpFaceRecognition(self._frame, self._lbpFaces, self._gray)
+	self._scheduler.record("recognize", time.time() - start)
 
 	print("Face Recognition done.")
-	self._audioctl.cmdSound("recognitiondone", wait=True)
-	self._audioctl.cmdSound("peoplerecognized", wait=True)
+	print("Announcements:", self._audioctl.getIdentityStats())
+	self._audioctl.cmdAnnounce(GCo.AU_RECOGNITIONDONE)
+	self._audioctl.cmdAnnounce(GCo.AU_PEOPLERECOGNIZED)
+
+
+    def executeTracking(self):
+        ###########################################
+        # Continuous mode, the detector only runs when the tracks
+        # need a refresh and only new or uncertain tracks are
+        # recognized, the others keep their cached people
+        ###########################################
+        self._gray = cv2.cvtColor(self._frame, cv2.COLOR_BGR2GRAY)
+        if self._nm.isTriggerFlagEnabled() or self._tracker.needsDetection():
+            self._nm.setTriggerFlagEnabled(False)
+            method = self._nm.getDetectionMethod()
+            with self._scheduler.measure(self._scheduler.detectStage(method, self._detectionScale)):
+                detections = self._detectors[method].faceDetection(self._frame, self._gray, self._detectionScale)
+            self._tracker.update(self._frame, detections)
+            print("Tracking:", self._tracker.getStats())
+        else:
+            with self._scheduler.measure("follow"):
+                self._tracker.follow(self._frame)
 
+        people_detected = len(self._tracker.getTracks())
+        self._lbp_people_detected = 0
+        self._hc_people_detected = 0
+        self._dnn_people_detected = 0
+        if self._nm.getDetectionMethod() == GCo.HAAR_CASCADE:
+            self._hc_people_detected = people_detected
+        elif self._nm.getDetectionMethod() == GCo.DNN:
+            self._dnn_people_detected = people_detected
+        else: # LBP
+            self._lbp_people_detected = people_detected
+
+        if self._nm.isRecognitionEnabled():
+            pending = self._tracker.pendingRecognition()
+            if len(pending) > 0:
+                self._faceRec.setAudioEnabled(True)
+                with self._scheduler.measure("recognize"):
+                    results = self._faceRec.predictBatch(self._gray, self._tracker.getFaces(pending))
+                self._tracker.assignPeople(pending, results)
+        return people_detected
 
     def applyDetectionsAndDisplay(self):
         ##############################################################################
         # If time to process a new image
         ##############################################################################
-        if self._triggerCounter == 0 and (self._nm.isDetectionEnabled() or self._nm.isRecognitionEnabled()):
+        if self.isTracking():
+            self._faceRec.tracksApplyRecognitions(self._frame, self._tracker.getTracks())
+        elif self._triggerCounter == 0 and (self._nm.isDetectionEnabled() or self._nm.isRecognitionEnabled()):
             filename = self._im.writeImage(self._frame, self._path + GCo.IMAGES_BEF_PROCESS, play_sound=False)
             print(filename)
 
@@ -1580,7 +4165,7 @@ class MainController():
                 if len(lbp_names) > 0 or len(eigen_names) > 0 or len(fisher_names) > 0:
                     self._faceRec.haarCascadeApplyRecognitions(self._frame, lbp_names, eigen_names, fisher_names)
                     self._faceRec.setAudioEnabled(False)
-            elif self._nm.getDetectionMethod() == GCo.DNN and self._dnnFaces != None and self._dnnFaces > 0:
+            elif self._nm.getDetectionMethod() == GCo.DNN and self._dnnFaces is not None and len(self._dnnFaces) > 0:
                 self._dnnDet.applyDetections(self._frame)
                 lbp_names, eigen_names, fisher_names = self._faceRec.getNames()
                 if len(lbp_names) > 0 or len(eigen_names) > 0 or len(fisher_names) > 0:
@@ -1596,6 +4181,8 @@ class MainController():
         ##############################################################################
         if rc == GCo.NM_TRAINNOW:
             print("Registration to be started")
+            for detector in self._detectors.values():
+                detector.prefetch()
             self._dnnRegFaces = []
             self._hcRegFaces = []
             self._lbpRegFaces = []
@@ -1639,26 +4226,41 @@ class MainController():
         #if self.loadingError:
         #    return 1
 
-        # Skip N frames to give time raspberry pi to be better responsive
-        skipFrames = 3
+        start = time.time()
+        self._pollTraining()
+        self._schedule()
+        self._detectors[self._nm.getDetectionMethod()].prefetch()
+
+        # The camera grabber keeps the newest frames buffered, so just ask
+        # for one newer than the last processed frame (or newer than the
+        # photo prompt in registration mode)
+        since = self._frameTime
         if self._nm.isRegistrationMode():
             self._audioctl.cmdSound(GCo.AU_PHOTONOW, wait=True)
-            skipFrames = 60
+            since = time.time()
 
-        self._ret, xframe = self.takePicture(skipFrames)
+        self._ret, xframe = self.takePicture(since)
         if self._ret == 0:
            self._frame = xframe
 
         self._gray = None
+        if not self.isTracking():
+           self._tracker.reset()
 
         if self._nm.isRegistrationMode():
            return self.captureFace()
+        elif self.isTracking():
+           self.executeTracking()
         elif self._nm.isDetectionEnabled():
            people_detected = self.executeDetection()
            if self._nm.isRecognitionEnabled() and people_detected > 0:
                self.executeRecognition()
  
-        return self.applyDetectionsAndDisplay()
+        rc = self.applyDetectionsAndDisplay()
+        elapsed = time.time() - start
+        self._scheduler.record("loop", elapsed)
+        self._scheduler.record("work", max(elapsed - self._waitTime / 1000.0, 0))
+        return rc
 
 
 def getDetectionsDir(path):
@@ -1669,26 +4271,31 @@ def getDetectionsDir(path):
 # Main Entry point
 ###########################################
 if __name__ == '__main__':
+    # the prompts play (in order) while the components are loading
+    timeline = BootTimeline()
     audioctl = AudioController()
-    audioctl.cmdSound(GCo.AU_WELCOME, wait=True)
-    audioctl.cmdSound(GCo.AU_LOADING, wait=False)
+    audioctl.cmdBoot(GCo.AU_WELCOME)
+    audioctl.cmdBoot(GCo.AU_LOADING)
 
     db = DataBase()
 
-    trainer = Trainer()
+    trainer = timeline.measure("trainer", Trainer)
 
     # NOTE:
-    #    Enable this condition if willing to rebuild the whole db
+    #    Run "python main.py --rebuild" to rebuild the whole db
     #    and retrain database during loading
-    if False:
-        trainer.trainAll()
+    if "--rebuild" in sys.argv:
+        timeline.measure("rebuild", trainer.trainAll)
 
     camera = Camera()
-    camera.start()
+    camera_started = timeline.start("camera", camera.start)
 
-    controller = MainController(trainer)
+    controller = timeline.measure("main controller", MainController, trainer)
+    camera_started.get()
 
-    audioctl.cmdSound(GCo.AU_READY, wait=False)
+    audioctl.cmdBoot(GCo.AU_READY)
+    timeline.mark("ready")
+    timeline.report()
 
     ###########################################
     # Enter to a loop reading for camera frames
@@ -1698,7 +4305,11 @@ if __name__ == '__main__':
             print("Closing controller")
             break;
     
+    controller.close()
+    timeline.close()
     camera.close()
+    db.close()
+    audioctl.close()
 
     Keypad().exit()
     GPIO.cleanup()